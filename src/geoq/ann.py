@@ -0,0 +1,476 @@
+"""Approximate nearest neighbours search, for databases too large to scan
+entirely (or to hold in memory) at each query.
+
+- `IVFIndex`: the vectors are clustered with k-means, and each query is
+  only compared to the vectors of its 'nprobe' closest clusters.
+- `PQIndex`: the vectors are compressed with product quantization, and
+  queries are scored against the codes, optionally re-ranking a shortlist
+  with the exact vectors.
+- `CascadeSearch`: for Matryoshka embeddings (Clay, Gemini), whose first
+  dims are an embedding on their own, all the vectors are scored on a few
+  dims, and shortlists are re-ranked with more and more of them.
+
+All of them work on any embeddings matrix, e.g. `ChipStore.text_embedding` or
+`ChipStore.image_embedding`.
+"""
+
+import numpy as np
+from loguru import logger
+
+from .search import SearchEngine, candidate_distances, squared_distances, topk
+
+
+def kmeans(vectors, n_clusters, n_iter=20, sample_size=None, block_size=16384, seed=0):
+    """
+    Lloyd's k-means on the rows of 'vectors'.
+
+    sample_size: number of rows (randomly chosen) to train on, all if None.
+                 a few hundred rows per cluster are usually enough.
+
+    returns: centroids, float32 [n_clusters, dim]
+    """
+    rng = np.random.default_rng(seed)
+    x = np.asarray(vectors, dtype=np.float32)
+    if sample_size is not None and sample_size < len(x):
+        x = x[np.sort(rng.choice(len(x), sample_size, replace=False))]
+    if len(x) < n_clusters:
+        raise ValueError(f"cannot find {n_clusters} clusters in {len(x)} vectors")
+
+    centroids = x[rng.choice(len(x), n_clusters, replace=False)].copy()
+    for it in range(n_iter):
+        # scored in blocks of rows, not as one [n, n_clusters] matrix
+        assignment = assign(x, centroids, block_size=block_size)
+
+        counts = np.bincount(assignment, minlength=n_clusters)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, x)
+        empty = counts == 0
+        centroids[~empty] = sums[~empty] / counts[~empty, None]
+
+        # empty clusters restart on random vectors
+        if empty.any():
+            centroids[empty] = x[rng.choice(len(x), empty.sum(), replace=False)]
+        logger.debug(f"kmeans iteration {it + 1}/{n_iter}, {empty.sum()} empty clusters")
+    return centroids
+
+
+def assign(vectors, centroids, block_size=16384):
+    """index of the closest centroid of each row of 'vectors', -1 for rows with NaNs"""
+    engine = SearchEngine(centroids, block_size=block_size)
+    assignment = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), block_size):
+        block = np.asarray(vectors[start:start + block_size], dtype=np.float32)
+        _, i = engine.search(block, k=1)
+        i = i[:, 0]
+        i[np.isnan(block).any(axis=1)] = -1
+        assignment[start:start + len(block)] = i
+    return assignment
+
+
+def valid_rows(vectors, block_size=16384):
+    """indices of the rows of 'vectors' without NaNs"""
+    return np.concatenate([
+        start + np.flatnonzero(~np.isnan(np.asarray(vectors[start:start + block_size])).any(axis=1))
+        for start in range(0, len(vectors), block_size)
+    ] or [np.zeros(0, dtype=np.int64)])
+
+
+class IVFIndex:
+
+    def __init__(self, n_lists=None, nprobe=8, n_iter=20, train_size=None, seed=0):
+        """
+        inverted file index: the vectors are grouped by their closest k-means
+        centroid (their list), and a query only scans the lists of its
+        'nprobe' closest centroids.
+
+        n_lists: number of clusters, 4 * sqrt(n) if None.
+        nprobe: default number of lists scanned per query. more lists means
+              better recall but slower queries, nprobe=n_lists is exact search.
+        n_iter: k-means iterations.
+        train_size: number of vectors used to train k-means, 256 per list if None.
+        """
+        self.n_lists = n_lists
+        self.nprobe = nprobe
+        self.n_iter = n_iter
+        self.train_size = train_size
+        self.seed = seed
+        self.centroids = None
+
+    def build(self, vectors):
+        """
+        vectors: [n, dim], rows with NaNs (chips without embedding) are left out.
+                 they are copied into the index, grouped by list.
+        """
+        valid = valid_rows(vectors)
+        n_lists = self.n_lists or max(1, int(4 * np.sqrt(len(valid))))
+        n_lists = min(n_lists, len(valid))
+        train_size = self.train_size or 256 * n_lists
+
+        logger.info(f"training {n_lists} lists on {min(train_size, len(valid))} of {len(valid)} vectors")
+        rng = np.random.default_rng(self.seed)
+        sample = np.sort(rng.choice(valid, min(train_size, len(valid)), replace=False))
+        self.centroids = kmeans(np.asarray(vectors[sample]), n_lists, n_iter=self.n_iter, seed=self.seed)
+        self.n_lists = n_lists
+
+        assignment = assign(vectors, self.centroids)
+        order = np.argsort(assignment, kind='stable')
+        order = order[assignment[order] >= 0]
+        self._set_lists(
+            ids=order,
+            vectors=np.asarray(vectors[order], dtype=np.float32),
+            offsets=np.searchsorted(assignment[order], np.arange(n_lists + 1)),
+        )
+        return self
+
+    def _set_lists(self, ids, vectors, offsets):
+        self.ids = ids
+        self.vectors = vectors
+        self.offsets = offsets
+        self.norms = np.einsum('ij,ij->i', vectors, vectors)
+
+    def __len__(self):
+        return 0 if self.centroids is None else len(self.ids)
+
+    def list_sizes(self):
+        return np.diff(self.offsets)
+
+    def search(self, queries, k=10, nprobe=None):
+        """
+        queries: [n_queries, dim] (or [dim] for a single query)
+        k: number of neighbours for each query
+        nprobe: number of lists scanned per query, self.nprobe if None
+
+        returns: distances [n_queries, k] (squared euclidean, ascending) and
+                 indices [n_queries, k] of the rows in the vectors the index
+                 was built from, -1 where less than k vectors were scanned.
+        """
+        if self.centroids is None:
+            raise ValueError("the index is empty, call build first")
+
+        queries = np.asarray(queries, dtype=np.float32)
+        single = queries.ndim == 1
+        queries = np.atleast_2d(queries)
+        nprobe = min(nprobe or self.nprobe, self.n_lists)
+
+        _, probes = SearchEngine(self.centroids).search(queries, k=nprobe)  # [q nprobe]
+
+        # scan list by list, with all the queries probing it at once
+        best_d = np.full((len(queries), k), np.inf, dtype=np.float32)
+        best_i = np.full((len(queries), k), -1, dtype=np.int64)
+        queries_norms = np.einsum('ij,ij->i', queries, queries)
+        probing = np.argsort(probes, axis=None, kind='stable') // nprobe  # queries grouped by list
+        lists_starts = np.searchsorted(np.sort(probes, axis=None), np.arange(self.n_lists + 1))
+        for l in np.unique(probes):
+            qs = probing[lists_starts[l]:lists_starts[l + 1]]
+            start, end = self.offsets[l], self.offsets[l + 1]
+            if len(qs) == 0 or start == end:
+                continue
+
+            d = squared_distances(queries[qs], self.vectors[start:end], self.norms[start:end], queries_norms[qs])
+            d, i = topk(d, k)
+            d = np.concatenate([best_d[qs], d], axis=1)
+            i = np.concatenate([best_i[qs], self.ids[start + i]], axis=1)
+            d, top = topk(d, k)
+            best_d[qs], best_i[qs] = d, np.take_along_axis(i, top, axis=1)
+
+        order = np.argsort(best_d, axis=1, kind='stable')
+        best_d = np.take_along_axis(best_d, order, axis=1)
+        best_i = np.take_along_axis(best_i, order, axis=1)
+
+        if single:
+            return best_d[0], best_i[0]
+        return best_d, best_i
+
+    def save(self, path):
+        """saves the index to a .npz file"""
+        np.savez(
+            path,
+            centroids=self.centroids,
+            ids=self.ids,
+            vectors=self.vectors,
+            offsets=self.offsets,
+            nprobe=self.nprobe,
+        )
+
+    @classmethod
+    def load(cls, path):
+        z = np.load(path)
+        index = cls(n_lists=len(z['centroids']), nprobe=int(z['nprobe']))
+        index.centroids = z['centroids']
+        index._set_lists(ids=z['ids'], vectors=z['vectors'], offsets=z['offsets'])
+        return index
+
+
+def recall_at_k(indices, exact_indices):
+    """
+    fraction of the exact k nearest neighbours (e.g. from `SearchEngine.search`)
+    found by an approximate search, averaged over the queries.
+    """
+    indices, exact_indices = np.atleast_2d(indices), np.atleast_2d(exact_indices)
+    found = [
+        len(np.intersect1d(i, e[e >= 0])) / max(1, (e >= 0).sum())
+        for i, e in zip(indices, exact_indices)
+    ]
+    return float(np.mean(found))
+
+
+class ProductQuantizer:
+
+    def __init__(self, n_subspaces=64, n_centroids=256, n_iter=20, train_size=65536, seed=0):
+        """
+        product quantization codec: the vectors are split in 'n_subspaces'
+        chunks of dims, and each chunk is replaced by the index of its closest
+        centroid among 'n_centroids' learned with k-means, i.e. one uint8 per
+        chunk. a 1024-d float32 vector takes 64 bytes with 64 subspaces (64x less).
+        """
+        if n_centroids > 256:
+            raise ValueError(f"at most 256 centroids per subspace (uint8 codes), but found {n_centroids}")
+        self.n_subspaces = n_subspaces
+        self.n_centroids = n_centroids
+        self.n_iter = n_iter
+        self.train_size = train_size
+        self.seed = seed
+        self.codebooks = None  # [n_subspaces, n_centroids, sub_dim]
+
+    def _split(self, vectors):
+        n, dim = vectors.shape
+        if dim % self.n_subspaces != 0:
+            raise ValueError(f"dim {dim} is not divisible in {self.n_subspaces} subspaces")
+        return vectors.reshape(n, self.n_subspaces, dim // self.n_subspaces)
+
+    def train(self, vectors):
+        """vectors: [n, dim] without NaNs, at most 'train_size' random rows are used"""
+        rng = np.random.default_rng(self.seed)
+        x = np.asarray(vectors, dtype=np.float32)
+        if len(x) > self.train_size:
+            x = x[np.sort(rng.choice(len(x), self.train_size, replace=False))]
+
+        x = self._split(x)
+        self.codebooks = np.stack([
+            kmeans(x[:, j], self.n_centroids, n_iter=self.n_iter, seed=self.seed)
+            for j in range(self.n_subspaces)
+        ])
+        return self
+
+    def encode(self, vectors, block_size=16384):
+        """[n, dim] vectors to [n, n_subspaces] uint8 codes"""
+        codes = np.empty((len(vectors), self.n_subspaces), dtype=np.uint8)
+        for start in range(0, len(vectors), block_size):
+            block = self._split(np.asarray(vectors[start:start + block_size], dtype=np.float32))
+            for j in range(self.n_subspaces):
+                codes[start:start + len(block), j] = assign(block[:, j], self.codebooks[j])
+        return codes
+
+    def decode(self, codes):
+        """[n, n_subspaces] codes to their approximate [n, dim] vectors"""
+        sub = self.codebooks[np.arange(self.n_subspaces), codes]  # [n n_subspaces sub_dim]
+        return sub.reshape(len(codes), -1)
+
+    def distance_tables(self, queries):
+        """
+        [n_queries, n_subspaces, n_centroids] squared distances of each
+        chunk of the queries to the centroids of its subspace.
+        """
+        q = self._split(np.asarray(queries, dtype=np.float32))
+        diff = q[:, :, None, :] - self.codebooks[None]
+        return np.einsum('qjcd,qjcd->qjc', diff, diff)
+
+    def asymmetric_distances(self, tables, codes):
+        """
+        [n_queries, n] approximate squared distances from the (exact) queries
+        of 'tables' to the encoded vectors, as a sum of table lookups.
+        """
+        d = np.zeros((len(tables), len(codes)), dtype=np.float32)
+        for j in range(self.n_subspaces):
+            d += tables[:, j, codes[:, j]]
+        return d
+
+
+class PQIndex:
+
+    def __init__(self, quantizer=None, block_size=65536):
+        """
+        compressed index holding only the product quantization codes of the
+        vectors, searched with asymmetric distances (exact queries against
+        encoded vectors).
+
+        quantizer: an untrained `ProductQuantizer`, one with default
+              parameters if None.
+        block_size: number of codes scored at once.
+        """
+        self.quantizer = quantizer or ProductQuantizer()
+        self.block_size = block_size
+        self.codes = None
+        self.ids = None
+
+    def build(self, vectors):
+        """vectors: [n, dim], rows with NaNs (chips without embedding) are left out"""
+        valid = valid_rows(vectors)
+        rng = np.random.default_rng(self.quantizer.seed)
+        sample = np.sort(rng.choice(valid, min(self.quantizer.train_size, len(valid)), replace=False))
+
+        logger.info(f"training {self.quantizer.n_subspaces} subspaces on {len(sample)} of {len(valid)} vectors")
+        self.quantizer.train(np.asarray(vectors[sample]))
+        self.ids = valid
+        self.codes = self.quantizer.encode(vectors, block_size=self.block_size)[valid]
+        return self
+
+    def __len__(self):
+        return 0 if self.codes is None else len(self.codes)
+
+    def search(self, queries, k=10, vectors=None, rerank=None):
+        """
+        queries: [n_queries, dim] (or [dim] for a single query)
+        k: number of neighbours for each query
+        vectors: the exact [n, dim] vectors the index was built from (e.g. a
+              memmapped store column). if given, the 'rerank' best candidates
+              by asymmetric distance are re-ranked with exact distances.
+        rerank: size of the shortlist re-ranked when vectors are given, 4 * k
+              if None.
+
+        returns: distances [n_queries, k] (squared euclidean, ascending, exact
+                 only when re-ranked) and indices [n_queries, k] of the rows in
+                 the vectors the index was built from, -1 where the index holds
+                 less than k vectors.
+        """
+        if self.codes is None:
+            raise ValueError("the index is empty, call build first")
+
+        queries = np.asarray(queries, dtype=np.float32)
+        single = queries.ndim == 1
+        queries = np.atleast_2d(queries)
+        shortlist = k if vectors is None else max(k, rerank or 4 * k)
+
+        tables = self.quantizer.distance_tables(queries)
+        best_d = np.zeros((len(queries), 0), dtype=np.float32)
+        best_i = np.zeros((len(queries), 0), dtype=np.int64)
+        for start in range(0, len(self.codes), self.block_size):
+            d = self.quantizer.asymmetric_distances(tables, self.codes[start:start + self.block_size])
+            d, i = topk(d, shortlist)
+            d = np.concatenate([best_d, d], axis=1)
+            i = np.concatenate([best_i, start + i], axis=1)
+            best_d, top = topk(d, shortlist)
+            best_i = np.take_along_axis(i, top, axis=1)
+        best_i = self.ids[best_i]
+
+        if vectors is not None:
+            best_d, best_i = rerank_exact(queries, best_i, vectors, k)
+        else:
+            order = np.argsort(best_d, axis=1, kind='stable')
+            best_d = np.take_along_axis(best_d, order, axis=1)
+            best_i = np.take_along_axis(best_i, order, axis=1)
+            if best_d.shape[1] < k:
+                # less than k codes in the index
+                missing = k - best_d.shape[1]
+                best_d = np.pad(best_d, ((0, 0), (0, missing)), constant_values=np.inf)
+                best_i = np.pad(best_i, ((0, 0), (0, missing)), constant_values=-1)
+
+        if single:
+            return best_d[0], best_i[0]
+        return best_d, best_i
+
+    def compression_ratio(self, dtype=np.float32):
+        """bytes of a vector in 'dtype' over bytes of its code"""
+        dim = self.quantizer.codebooks.shape[0] * self.quantizer.codebooks.shape[2]
+        return dim * np.dtype(dtype).itemsize / self.codes.shape[1]
+
+    def save(self, path):
+        """saves the index to a .npz file"""
+        np.savez(path, codebooks=self.quantizer.codebooks, codes=self.codes, ids=self.ids)
+
+    @classmethod
+    def load(cls, path, block_size=65536):
+        z = np.load(path)
+        codebooks = z['codebooks']
+        index = cls(ProductQuantizer(n_subspaces=codebooks.shape[0], n_centroids=codebooks.shape[1]), block_size=block_size)
+        index.quantizer.codebooks = codebooks
+        index.codes = z['codes']
+        index.ids = z['ids']
+        return index
+
+
+def rerank_exact(queries, candidates, vectors, k, dims=None):
+    """
+    exact squared distances from each query to its candidate rows of
+    'vectors' ([n_queries, n_candidates] indices, -1 for none), keeping the k
+    closest. returns distances and indices [n_queries, k], sorted.
+
+    dims: only use the first 'dims' dimensions, all if None.
+    """
+    d = candidate_distances(queries, candidates, vectors, dims=dims)
+    d, top = topk(d, k)
+    order = np.argsort(d, axis=1, kind='stable')
+    best_d = np.take_along_axis(d, order, axis=1)
+    best_i = np.take_along_axis(candidates, np.take_along_axis(top, order, axis=1), axis=1)
+
+    if best_d.shape[1] < k:
+        missing = k - best_d.shape[1]
+        best_d = np.pad(best_d, ((0, 0), (0, missing)), constant_values=np.inf)
+        best_i = np.pad(best_i, ((0, 0), (0, missing)), constant_values=-1)
+    best_i[~np.isfinite(best_d)] = -1
+    return best_d, best_i
+
+
+class CascadeSearch:
+
+    def __init__(self, vectors, stages=((64, 1024), (256, 128)), block_size=16384):
+        """
+        coarse to fine search over Matryoshka embeddings (trained so that
+        their first dims are a good embedding too, as the Clay encoder with
+        its dolls [16, 32, 64, ...] and Gemini embeddings).
+
+        vectors: [n, dim] embeddings, e.g. a memmapped store column. only a
+              copy of their first stages[0][0] dims is kept in memory.
+        stages: (dims, shortlist size) of each stage. the first one scores all
+              the vectors on its dims and keeps its shortlist, each next one
+              re-ranks the previous shortlist on its dims, and the k results
+              are re-ranked on all the dims.
+        """
+        dims = [d for d, _ in stages]
+        if dims != sorted(dims) or dims[-1] > vectors.shape[1]:
+            raise ValueError(f"expecting increasing stage dims up to {vectors.shape[1]}, but found {dims}")
+
+        self.vectors = vectors
+        self.stages = tuple(stages)
+
+        coarse_dims = stages[0][0]
+        prefix = np.empty((len(vectors), coarse_dims), dtype=np.float32)
+        for start in range(0, len(vectors), block_size):
+            prefix[start:start + block_size] = vectors[start:start + block_size, :coarse_dims]
+        self.coarse = SearchEngine(prefix, block_size=block_size)
+
+    def __len__(self):
+        return len(self.vectors)
+
+    def search(self, queries, k=10):
+        """
+        queries: [n_queries, dim] (or [dim] for a single query)
+        k: number of neighbours for each query
+
+        returns: distances [n_queries, k] (squared euclidean on all the
+                 dims, ascending) and indices [n_queries, k] of the rows
+        """
+        queries = np.asarray(queries, dtype=np.float32)
+        single = queries.ndim == 1
+        queries = np.atleast_2d(queries)
+
+        (dims, n), *stages = self.stages
+        _, candidates = self.coarse.search(queries[:, :dims], k=max(n, k))
+        for dims, n in stages:
+            _, candidates = rerank_exact(queries, candidates, self.vectors, max(n, k), dims=dims)
+        distances, indices = rerank_exact(queries, candidates, self.vectors, k)
+
+        if single:
+            return distances[0], indices[0]
+        return distances, indices
+
+    def recall(self, queries, k=10, exact_indices=None):
+        """
+        recall@k of the cascade against exact search on all the dims (computed
+        with `SearchEngine` if 'exact_indices' is None).
+        """
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        if exact_indices is None:
+            _, exact_indices = SearchEngine(self.vectors).search(queries, k=k)
+        _, indices = self.search(queries, k=k)
+        return recall_at_k(indices, exact_indices)
@@ -0,0 +1,130 @@
+"""Cache of text embeddings, so that repeated queries do not go back to the
+embeddings API. An in memory LRU sits in front of an optional SQLite file
+shared by all the processes using the same path.
+"""
+
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+import numpy as np
+
+
+def normalize_text(text):
+    """unicode NFC with collapsed whitespace, so that trivially different queries share an entry"""
+    return ' '.join(unicodedata.normalize('NFC', text).split())
+
+
+class EmbeddingCache:
+
+    def __init__(self, path=None, max_items=10000, ttl_secs=None):
+        """
+        path: SQLite file persisting the embeddings across runs and processes,
+              memory only if None.
+        max_items: number of embeddings kept in memory, least recently used
+              ones are evicted first.
+        ttl_secs: age after which an embedding is not used anymore (and
+              removed), never if None.
+        """
+        self.path = path
+        self.max_items = max_items
+        self.ttl_secs = ttl_secs
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._memory = OrderedDict()  # key -> (created, embedding)
+        self._lock = threading.Lock()
+        self._db = None
+
+        if path is not None:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self._db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings "
+                "(key TEXT PRIMARY KEY, created REAL, dtype TEXT, value BLOB)"
+            )
+            self._db.commit()
+
+    @staticmethod
+    def key(model_name, task_type, text):
+        return f"{model_name}\x1f{task_type}\x1f{normalize_text(text)}"
+
+    def _expired(self, created):
+        return self.ttl_secs is not None and time.time() - created > self.ttl_secs
+
+    def get(self, key):
+        """the cached embedding for 'key', None if missing or expired"""
+        with self._lock:
+            if key in self._memory:
+                created, embedding = self._memory[key]
+                if not self._expired(created):
+                    self._memory.move_to_end(key)
+                    self.hits += 1
+                    return embedding
+                del self._memory[key]
+
+            if self._db is not None:
+                row = self._db.execute(
+                    "SELECT created, dtype, value FROM embeddings WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None:
+                    created, dtype, value = row
+                    if not self._expired(created):
+                        embedding = np.frombuffer(value, dtype=dtype).copy()
+                        self._remember(key, created, embedding)
+                        self.hits += 1
+                        self.disk_hits += 1
+                        return embedding
+                    self._db.execute("DELETE FROM embeddings WHERE key = ?", (key,))
+                    self._db.commit()
+
+            self.misses += 1
+            return None
+
+    def put(self, key, embedding):
+        embedding = np.asarray(embedding)
+        created = time.time()
+        with self._lock:
+            self._remember(key, created, embedding)
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?)",
+                    (key, created, embedding.dtype.str, embedding.tobytes()),
+                )
+                self._db.commit()
+
+    def _remember(self, key, created, embedding):
+        self._memory[key] = (created, embedding)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_items:
+            self._memory.popitem(last=False)
+
+    def prune(self):
+        """removes the expired embeddings from the SQLite file"""
+        if self._db is None or self.ttl_secs is None:
+            return
+        with self._lock:
+            self._db.execute("DELETE FROM embeddings WHERE created < ?", (time.time() - self.ttl_secs,))
+            self._db.commit()
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM embeddings")
+                self._db.commit()
+
+    def stats(self):
+        """hit and miss counters since creation"""
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups > 0 else 0.0,
+            'memory_items': len(self._memory),
+        }
@@ -1,6 +1,17 @@
 from .wrapper import *
 from .utils import *
-from .module import *
 from .model import *
 from .factory import *
 from .backbone import *
+from .export import *
+from .pipeline import *
+
+
+def __getattr__(name):
+    # the lightning module is only needed for the full (training) model, so
+    # lightning is not imported until it is used
+    if name == "ClayMAEModule":
+        from .module import ClayMAEModule
+
+        return ClayMAEModule
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,203 @@
+"""Export of the Clay encoder inference path (TorchScript / ONNX) and the
+backends to run the exported graphs from `ClayWrapper`, so that serving
+embeddings does not need lightning, timm or torchvision.
+"""
+
+import os
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+import yaml
+from torch import nn
+
+export_formats = ("onnx", "torchscript")
+export_extensions = {"onnx": "onnx", "torchscript": "ts"}
+
+
+class ClayInferenceEncoder(nn.Module):
+    """
+    Encoder-only inference graph for a fixed image size. The wave conditioned
+    patch embedding kernel and the position encodings are computed once and
+    frozen as buffers, time and latlon are zero (as in `ClayWrapper`).
+
+    forward takes normalized pixels [B 3 H W] and returns (embeddings,
+    embeddings_raw), both [B D]: the mean of the encoded patches, standardized
+    with the embeddings constants and as is.
+    """
+
+    def __init__(  # noqa: PLR0913
+        self,
+        encoder,
+        image_size,
+        embeddings_means,
+        embeddings_stds,
+        gsd=10.0,
+        waves=(1552.0, 1355.0, 1105.0),
+        patch_stride=1,
+        transformer=None,
+    ):
+        super().__init__()
+        self.image_size = image_size
+        self.patch_size = encoder.patch_size
+        self.patch_stride = patch_stride
+        self.dim = encoder.dim
+
+        device = encoder.cls_token.device
+        grid_size = image_size // self.patch_size
+        with torch.no_grad():
+            kernel, bias, _ = encoder.patch_embedding.dynamic_weights(
+                torch.tensor(waves), device
+            )
+            pos_encoding = encoder.position_encoding(grid_size, gsd, device)  # [L D]
+
+        self.register_buffer("kernel", kernel.detach().clone())
+        self.register_buffer("bias", bias.detach().clone())
+        self.register_buffer("pos_encoding", pos_encoding.clone())
+
+        # indices of the patches kept with patch_stride, see `Encoder.encode`
+        grid = torch.arange(grid_size**2, device=device).view(grid_size, grid_size)
+        self.register_buffer(
+            "patch_indices", grid[::patch_stride, ::patch_stride].flatten()
+        )
+
+        self.cls_token = encoder.cls_token
+        self.transformer = encoder.transformer if transformer is None else transformer
+
+        self.register_buffer(
+            "embeddings_means",
+            torch.tensor(embeddings_means, dtype=torch.float32, device=device),
+        )
+        self.register_buffer(
+            "embeddings_stds",
+            torch.tensor(embeddings_stds, dtype=torch.float32, device=device),
+        )
+
+    def forward(self, pixels):
+        patches = F.conv2d(
+            pixels, self.kernel, bias=self.bias, stride=self.patch_size
+        )  # [B D h w]
+        patches = patches.flatten(2).transpose(1, 2)  # [B L D]
+        patches = patches + self.pos_encoding  # [B L D]
+        patches = patches[:, self.patch_indices, :]  # [B L' D]
+
+        cls_tokens = self.cls_token.expand(patches.shape[0], -1, -1)  # [B 1 D]
+        encoded_patches = self.transformer(
+            torch.cat((cls_tokens, patches), dim=1)
+        )  # [B (1 + L') D]
+
+        embeddings_raw = encoded_patches[:, 1:, :].mean(dim=1)  # [B D]
+        embeddings = (embeddings_raw - self.embeddings_means) / self.embeddings_stds
+        return embeddings, embeddings_raw
+
+
+def export_encoder(inference_encoder, path, format="onnx", opset_version=17):
+    """
+    exports a `ClayInferenceEncoder` to 'path' in 'format' ('onnx' or
+    'torchscript'), with a dynamic batch size. the image size, patch size,
+    patch stride and embeddings dim are saved next to it in 'path.yaml'.
+    """
+    if format not in export_formats:
+        raise ValueError(f"format must be one of {export_formats}, but found '{format}'")
+
+    inference_encoder = inference_encoder.eval()
+    device = inference_encoder.kernel.device
+    size = inference_encoder.image_size
+    example = torch.zeros((1, 3, size, size), device=device)
+
+    with torch.no_grad():
+        if format == "torchscript":
+            traced = torch.jit.trace(inference_encoder, example)
+            torch.jit.save(traced, path)
+        else:
+            torch.onnx.export(
+                inference_encoder,
+                (example,),
+                path,
+                input_names=["pixels"],
+                output_names=["embeddings", "embeddings_raw"],
+                dynamic_axes={
+                    "pixels": {0: "batch"},
+                    "embeddings": {0: "batch"},
+                    "embeddings_raw": {0: "batch"},
+                },
+                opset_version=opset_version,
+                dynamo=False,
+            )
+
+    with open(f"{path}.yaml", "w") as f:
+        yaml.safe_dump(
+            {
+                "format": format,
+                "image_size": size,
+                "patch_size": inference_encoder.patch_size,
+                "patch_stride": inference_encoder.patch_stride,
+                "dim": inference_encoder.dim,
+            },
+            f,
+        )
+    return path
+
+
+class ExportedBackend:
+    """
+    base class of the backends running an exported encoder. they are called
+    with a normalized float32 tensor [B 3 H W] and return (embeddings,
+    embeddings_raw) as numpy arrays.
+    """
+
+    def __init__(self, path):
+        if not os.path.isfile(path) or not os.path.isfile(f"{path}.yaml"):
+            raise ValueError(f"expecting an exported encoder at '{path}' and its description at '{path}.yaml'")
+
+        with open(f"{path}.yaml") as f:
+            description = yaml.safe_load(f)
+
+        self.path = path
+        self.image_size = description["image_size"]
+        self.patch_size = description["patch_size"]
+        self.patch_stride = description["patch_stride"]
+        self.dim = description["dim"]
+
+    def __call__(self, pixels):
+        raise NotImplementedError
+
+
+class TorchScriptBackend(ExportedBackend):
+    def __init__(self, path, device="cpu"):
+        super().__init__(path)
+        self.device = torch.device(device)
+        self.module = torch.jit.load(path, map_location=self.device).eval()
+
+    def __call__(self, pixels):
+        with torch.no_grad():
+            embeddings, embeddings_raw = self.module(pixels.to(self.device))
+        return embeddings.cpu().numpy(), embeddings_raw.cpu().numpy()
+
+
+class OnnxRuntimeBackend(ExportedBackend):
+    def __init__(self, path, num_threads=None, providers=None):
+        super().__init__(path)
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads is not None:
+            options.intra_op_num_threads = num_threads
+
+        self.session = ort.InferenceSession(
+            path,
+            sess_options=options,
+            providers=providers or ["CPUExecutionProvider"],
+        )
+
+    def __call__(self, pixels):
+        if isinstance(pixels, torch.Tensor):
+            pixels = pixels.cpu().contiguous().numpy()
+        embeddings, embeddings_raw = self.session.run(
+            None, {"pixels": np.ascontiguousarray(pixels, dtype=np.float32)}
+        )
+        return embeddings, embeddings_raw
+
+
+backends = {"onnx": OnnxRuntimeBackend, "torchscript": TorchScriptBackend}
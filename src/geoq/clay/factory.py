@@ -4,6 +4,8 @@ Reference:
 - https://github.com/zhu-xlab/DOFA
 """
 
+from collections import OrderedDict
+
 import torch
 import torch.nn.functional as F
 from einops import rearrange
@@ -12,6 +14,17 @@ from torch import nn
 from .utils import posemb_sincos_1d
 
 
+def autocast_state(device):
+    """(enabled, dtype) of autocast for the type of 'device'"""
+    device_type = torch.device(device).type
+    if hasattr(torch, "get_autocast_dtype"):
+        return torch.is_autocast_enabled(device_type), torch.get_autocast_dtype(device_type)
+    # torch < 2.4
+    if device_type == "cpu":
+        return torch.is_autocast_cpu_enabled(), torch.get_autocast_cpu_dtype()
+    return torch.is_autocast_enabled(), torch.get_autocast_gpu_dtype()
+
+
 class FCBlock(nn.Module):
     def __init__(self, size):
         super().__init__()
@@ -67,13 +80,14 @@ class WavesTransformer(nn.Module):
 
 
 class DynamicEmbedding(nn.Module):
-    def __init__(
+    def __init__(  # noqa: PLR0913
         self,
         wave_dim,
         num_latent_tokens,
         patch_size,
         embed_dim,
         is_decoder=False,
+        kernel_cache_size=8,
     ):
         super().__init__()
         self.wave_dim = wave_dim
@@ -92,11 +106,29 @@ class DynamicEmbedding(nn.Module):
         )
         self.fclayer = FCBlock(self.wave_dim)
 
+        # dynamic weights only depend on the wavelengths, so in inference they
+        # are kept per (wavelengths, device, dtype), least recently used first
+        self.kernel_cache_size = kernel_cache_size
+        self._kernel_cache = OrderedDict()
+
         self.initialize_weights()
 
-    def forward(self, batch, waves):
+    def clear_kernel_cache(self):
+        self._kernel_cache.clear()
+
+    def train(self, mode=True):
+        # weights might change while training
+        self.clear_kernel_cache()
+        return super().train(mode)
+
+    def _load_from_state_dict(self, *args, **kwargs):
+        self.clear_kernel_cache()
+        return super()._load_from_state_dict(*args, **kwargs)
+
+    def dynamic_weights(self, waves, device):
+        """Generate the kernel (already scaled) and bias for the given wavelengths"""
         waves = posemb_sincos_1d(waves, self.wave_dim)
-        waves = waves.to(batch.device)
+        waves = waves.to(device)
         waves = self.fclayer(waves)
         weight, bias = self.weight_generator(waves)
 
@@ -108,10 +140,6 @@ class DynamicEmbedding(nn.Module):
                 k2=self.patch_size,
                 cout=self.embed_dim,
             )
-            if bias is not None:
-                bias = rearrange(bias, "b -> (b)")
-            dynamic_out = F.linear(batch, dynamic_weight * 0.02, bias=bias)
-            x = dynamic_out
         else:
             dynamic_weight = rearrange(
                 weight,
@@ -119,10 +147,43 @@ class DynamicEmbedding(nn.Module):
                 k1=self.patch_size,
                 k2=self.patch_size,
             )
-            if bias is not None:
-                bias = rearrange(bias, "b -> (b)")
+        if bias is not None:
+            bias = rearrange(bias, "b -> (b)")
+
+        return dynamic_weight * 0.02, bias, waves
+
+    def cached_dynamic_weights(self, waves, device, dtype):
+        """
+        Same as `dynamic_weights`, but memoized when not training and not
+        tracking gradients, since then the result only depends on the inputs
+        (and the autocast state).
+        """
+        if self.training or torch.is_grad_enabled() or self.kernel_cache_size == 0:
+            return self.dynamic_weights(waves, device)
+
+        # under autocast the linears generating the kernel run in lower precision
+        key = (tuple(float(w) for w in waves), str(device), dtype, autocast_state(device))
+        if key in self._kernel_cache:
+            self._kernel_cache.move_to_end(key)
+            return self._kernel_cache[key]
+
+        weights = self.dynamic_weights(waves, device)
+        self._kernel_cache[key] = weights
+        if len(self._kernel_cache) > self.kernel_cache_size:
+            self._kernel_cache.popitem(last=False)
+        return weights
+
+    def forward(self, batch, waves):
+        dynamic_weight, bias, waves = self.cached_dynamic_weights(
+            waves, batch.device, batch.dtype
+        )
+
+        if self.is_decoder:
+            dynamic_out = F.linear(batch, dynamic_weight, bias=bias)
+            x = dynamic_out
+        else:
             dynamic_out = F.conv2d(
-                batch, dynamic_weight * 0.02, bias=bias, stride=self.patch_size
+                batch, dynamic_weight, bias=bias, stride=self.patch_size
             )
             x = rearrange(dynamic_out, "b c h w -> b (h w) c")
 
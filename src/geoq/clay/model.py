@@ -3,13 +3,12 @@
 import math
 import os
 import random
+from collections import OrderedDict
 
-import timm
 import torch
 import torch.nn.functional as F
 from einops import rearrange, reduce, repeat
 from torch import nn
-from torchvision.transforms import v2
 
 from .backbone import Transformer
 from .factory import DynamicEmbedding
@@ -38,6 +37,9 @@ class Encoder(nn.Module):
         self.dim = dim
         self.cls_token = nn.Parameter(torch.randn(1, 1, dim) * 0.02)
 
+        self.position_encodings_cache_size = 8
+        self._position_encodings = OrderedDict()
+
         self.patch_embedding = DynamicEmbedding(
             wave_dim=128,
             num_latent_tokens=128,
@@ -60,33 +62,51 @@ class Encoder(nn.Module):
         patches, waves_encoded = self.patch_embedding(cube, waves)  # [B L D]
         return patches, waves_encoded  # ([B L D], [N D])
 
-    def add_encodings(self, patches, time, latlon, gsd):
-        """Add position encoding to the patches"""
-        B, L, D = patches.shape
-
-        grid_size = int(math.sqrt(L))
-        self.num_patches = grid_size**2
+    def position_encoding(self, grid_size, gsd, device):
+        """
+        Position encoding for a grid_size x grid_size patch grid, padded with
+        zeros in the last 8 dims (reserved for time & latlon). It only depends
+        on its arguments, so it is computed once and kept for later calls.
+        """
+        key = (grid_size, float(gsd), self.dim, str(device))
+        if key in self._position_encodings:
+            self._position_encodings.move_to_end(key)
+            return self._position_encodings[key]
 
         pos_encoding = (
             posemb_sincos_2d_with_gsd(
                 h=grid_size,
                 w=grid_size,
                 dim=(self.dim - 8),
-                gsd=gsd,
+                gsd=torch.as_tensor(gsd),
             )
-            .to(patches.device)
+            .to(device)
             .detach()
         )  # [L (D - 8)]
+        pos_encoding = F.pad(pos_encoding, (0, 8))  # [L D]
 
-        time_latlon = torch.hstack((time, latlon)).to(patches.device).detach()  # [B 8]
+        self._position_encodings[key] = pos_encoding
+        if len(self._position_encodings) > self.position_encodings_cache_size:
+            self._position_encodings.popitem(last=False)
+        return pos_encoding
 
-        pos_encoding = repeat(pos_encoding, "L D -> B L D", B=B)  # [B L (D - 8)]
-        time_latlon = repeat(time_latlon, "B D -> B L D", L=L)  # [B L 8]
-        pos_metadata_encoding = torch.cat(
-            (pos_encoding, time_latlon), dim=-1
-        )  # [B L D]
+    def add_encodings(self, patches, time, latlon, gsd):
+        """Add position encoding to the patches"""
+        B, L, D = patches.shape
+
+        grid_size = int(math.sqrt(L))
+        self.num_patches = grid_size**2
+
+        pos_encoding = self.position_encoding(
+            grid_size, gsd, patches.device
+        )  # [L D], 0 in the time & latlon dims
+
+        time_latlon = torch.hstack((time, latlon)).to(patches.device).detach()  # [B 8]
+        time_latlon = F.pad(time_latlon, (D - 8, 0))  # [B D], 0 in the position dims
 
-        patches = patches + pos_metadata_encoding  # [B L D] + [B L D] -> [B L D]
+        # broadcasting, so that no [B L D] encoding is ever materialized
+        patches = patches + pos_encoding  # [B L D] + [L D] -> [B L D]
+        patches += time_latlon[:, None, :]  # [B L D] + [B 1 D] -> [B L D]
         return patches  # [B L D]
 
     def mask_out(self, patches):
@@ -210,6 +230,71 @@ class Encoder(nn.Module):
             masked_matrix,
         )  # [B ((1 + L):(1 - mask_ratio)) D], [(1-mask_ratio)], [mask_ratio], [B L]
 
+    def encode(self, datacube, patch_stride=1):
+        """
+        Deterministic forward pass for inference. Unlike `forward`, patches are
+        neither masked out nor shuffled, so the same input always produces the
+        same embeddings.
+
+        Parameters
+        ----------
+        datacube : dict
+            Same keys as in `forward`.
+        patch_stride : int
+            1 to encode every patch. Larger values keep one patch every
+            `patch_stride` along each axis of the patch grid, always at the same
+            positions, so the output is still a regular grid and reproducible
+            (e.g. 2 keeps 1/4 of the tokens, the same budget as `forward` with
+            mask_ratio=0.75). This trades accuracy for throughput, since the
+            transformer cost grows with the square of the number of tokens.
+
+        Returns
+        -------
+        cls_tokens : torch.Tensor
+            A tensor of shape (B, D) with the encoded class token.
+        patch_grid : torch.Tensor
+            A tensor of shape (B, h, w, D) with the encoded patches in their
+            original spatial order, h = H // patch_size // patch_stride.
+        """
+        cube, time, latlon, gsd, waves = (
+            datacube["pixels"],  # [B C H W]
+            datacube["time"],  # [B 2]
+            datacube["latlon"],  # [B 2]
+            datacube["gsd"],  # 1
+            datacube["waves"],  # [N]
+        )
+
+        patches, _ = self.to_patch_embed(cube, waves)  # [B L D]
+        patches = self.add_encodings(patches, time, latlon, gsd)  # [B L D]
+        return self.encode_patches(patches, patch_stride=patch_stride)
+
+    def encode_patches(self, patches, patch_stride=1):
+        """
+        Run the transformer over all the patches (already embedded and with
+        position encodings added, see `encode`), without masking.
+        """
+        B, L, D = patches.shape
+        grid_size = int(math.sqrt(L))
+
+        patches = rearrange(
+            patches, "B (h w) D -> B h w D", h=grid_size, w=grid_size
+        )  # [B h w D]
+        if patch_stride > 1:
+            patches = patches[:, ::patch_stride, ::patch_stride, :]
+        _, h, w, _ = patches.shape
+        patches = rearrange(patches, "B h w D -> B (h w) D")  # [B L' D]
+
+        cls_tokens = repeat(self.cls_token, "1 1 D -> B 1 D", B=B)  # [B 1 D]
+        patches = torch.cat((cls_tokens, patches), dim=1)  # [B (1 + L') D]
+
+        encoded_patches = self.transformer(patches)  # [B (1 + L') D]
+
+        cls_tokens = encoded_patches[:, 0, :]  # [B D]
+        patch_grid = rearrange(
+            encoded_patches[:, 1:, :], "B (h w) D -> B h w D", h=h, w=w
+        )  # [B h w D]
+        return cls_tokens, patch_grid
+
 
 class Decoder(nn.Module):
     def __init__(  # noqa: PLR0913
@@ -381,6 +466,11 @@ class ClayMAE(nn.Module):
         decoder_mlp_ratio,
         **kwargs,
     ):
+        # only needed to train, imported here so that the encoder can be used
+        # without timm and torchvision
+        import timm
+        from torchvision.transforms import v2
+
         super().__init__()
         self.mask_ratio = mask_ratio
         self.patch_size = patch_size
@@ -624,3 +714,16 @@ def clay_mae_large(**kwargs):
     }
     args.update(kwargs)
     return ClayMAE(**args)
+
+
+def clay_encoder_large(**kwargs):
+    """Encoder of `clay_mae_large` alone, without teacher or decoder"""
+    args = {
+        "dim": 1024,
+        "depth": 24,
+        "heads": 16,
+        "dim_head": 64,
+        "mlp_ratio": 4,
+    }
+    args.update(kwargs)
+    return Encoder(**args)
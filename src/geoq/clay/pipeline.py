@@ -0,0 +1,138 @@
+import multiprocessing
+import os
+import pickle
+import queue
+import traceback
+
+import loguru
+import numpy as np
+import torch
+
+from .wrapper import ClayWrapper
+
+logger = loguru.logger
+
+
+def read_chip_image(fname):
+    """reads the image of a chip pickle file"""
+    with open(fname, 'rb') as f:
+        return pickle.load(f)['img']
+
+
+def embed_files(
+    files,
+    model_path,
+    n_workers=None,
+    threads_per_worker=4,
+    shard_size=64,
+    read_image=read_chip_image,
+    out=None,
+    wrapper_kwargs=None,
+    **kwargs,
+):
+    """
+    image embeddings of the chips in 'files' using 'n_workers' processes.
+
+    every worker builds its own encoder-only `ClayWrapper` limited to
+    'threads_per_worker' torch threads. the weights are loaded memory mapped
+    from the checkpoint (use `ClayWrapper.save_encoder_checkpoint` to create a
+    small encoder-only one), so all workers share them through the page cache
+    instead of holding one copy each.
+
+    files are sent to the workers in shards of 'shard_size' through a queue,
+    and the embeddings are written in the same order as 'files'.
+
+    read_image: function returning the image of a file. it must be importable
+          from a module (not a lambda), since workers are spawned processes.
+    out: None to return an in memory array, or the path of a .npy file to
+          write the embeddings to as they arrive.
+    wrapper_kwargs: passed to `ClayWrapper` (e.g. precision='int8')
+    kwargs: passed to `ClayWrapper.batch_embeddings` (e.g. patch_stride)
+
+    returns: float32 array [len(files), embeddings_dim] (a memmap if 'out' is given)
+    """
+    if n_workers is None:
+        n_workers = max(1, (os.cpu_count() or 1) // threads_per_worker)
+
+    files = list(files)
+    shards = [files[i:i + shard_size] for i in range(0, len(files), shard_size)]
+
+    context = multiprocessing.get_context("spawn")
+    tasks = context.Queue()
+    results = context.Queue()
+    for task in enumerate(shards):
+        tasks.put(task)
+    for _ in range(n_workers):
+        tasks.put(None)
+
+    workers = [
+        context.Process(
+            target=_worker,
+            args=(model_path, wrapper_kwargs or {}, threads_per_worker, read_image, kwargs, tasks, results),
+            daemon=True,
+        )
+        for _ in range(n_workers)
+    ]
+    logger.info(f"embedding {len(files)} files in {len(shards)} shards with {n_workers} workers")
+    for w in workers:
+        w.start()
+
+    embeddings = None
+    try:
+        for done in range(len(shards)):
+            i, e, error = _next_result(results, workers)
+            if error is not None:
+                raise RuntimeError(f"worker failed on shard {i}\n{error}")
+
+            if embeddings is None:
+                shape = (len(files), e.shape[1])
+                if out is None:
+                    embeddings = np.zeros(shape, dtype=np.float32)
+                else:
+                    embeddings = np.lib.format.open_memmap(out, mode='w+', dtype=np.float32, shape=shape)
+
+            embeddings[i * shard_size: i * shard_size + len(e)] = e
+            if (done + 1) % max(1, len(shards) // 20) == 0:
+                logger.info(f"{done + 1}/{len(shards)} shards done")
+    finally:
+        for w in workers:
+            if w.is_alive():
+                w.terminate()
+            w.join()
+
+    if embeddings is None:
+        embeddings = np.zeros((0, 0), dtype=np.float32)
+    elif out is not None:
+        embeddings.flush()
+    return embeddings
+
+
+def _next_result(results, workers):
+    while True:
+        try:
+            return results.get(timeout=1)
+        except queue.Empty:
+            dead = [w for w in workers if w.exitcode not in (None, 0)]
+            if len(dead) > 0:
+                raise RuntimeError(f"{len(dead)} workers died (exit code {dead[0].exitcode})")
+
+
+def _worker(model_path, wrapper_kwargs, threads, read_image, kwargs, tasks, results):
+    torch.set_num_threads(threads)
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        pass  # already set
+
+    cw = ClayWrapper(model_path, encoder_only=True, **wrapper_kwargs)
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+
+        i, shard = task
+        try:
+            e = cw.batch_embeddings((read_image(f) for f in shard), **kwargs)
+            results.put((i, e.astype(np.float32), None))
+        except Exception:
+            results.put((i, None, traceback.format_exc()))
@@ -1,9 +1,16 @@
 import torch
 import loguru
-from .module import ClayMAEModule
+import contextlib
+import time
+from torch import nn
+import torch.nn.functional as F
+from .model import clay_encoder_large
+from .export import ClayInferenceEncoder, ExportedBackend, backends, export_encoder, export_extensions
 import numpy as np
 from einops import rearrange, reduce, repeat
 import os
+import itertools
+import warnings
 import yaml
 
 logger = loguru.logger
@@ -11,17 +18,60 @@ logger = loguru.logger
 means = np.array([53.33853489, 44.41999383, 35.96075039])
 stds = np.array([50.44633167, 43.54469652, 44.63162242])
 
+encoder_checkpoint_name = 'clay-v1.5-encoder.ckpt'
+encoder_prefix = 'model.encoder.'
+
+precisions = ("fp32", "bf16", "int8")
+
+# memory used by default to size the batches sent to the model (bytes)
+default_memory_budget = 2 * 1024**3
+
 
 class ClayWrapper:
 
-    def __init__(self, path):
+    def __init__(self, path, encoder_only=False, memory_budget=default_memory_budget, precision="fp32", backend=None):
+        """
+        path: folder with 'metadata.yaml', 'embeddings-constants.yaml' and the
+              'clay-v1.5.ckpt' checkpoint ('metadata.yaml' is not needed with
+              encoder_only)
+
+        encoder_only: True to build only the Clay encoder (no DINOv2 teacher,
+              decoder or lightning module) and load only the 'model.encoder.*'
+              weights. If the folder contains 'clay-v1.5-encoder.ckpt' (see
+              `save_encoder_checkpoint`) it is used instead of the full checkpoint.
+
+        memory_budget: bytes, used to size the batches sent to the model
+              when no explicit batch size is given (see `auto_batch_size`)
+
+        precision: one of 'fp32', 'bf16' (autocast) or 'int8' (dynamic
+              quantization of the transformer linear layers, cpu only).
+              see `set_precision` and `precision_drift`.
+
+        backend: None to run the encoder with torch. 'onnx' or 'torchscript' to
+              run instead 'clay-v1.5-encoder.onnx' or 'clay-v1.5-encoder.ts' in
+              the folder, created with `export`, or an `ExportedBackend`
+              instance. exported encoders have a fixed image size and patch
+              stride, and need neither the checkpoint nor 'metadata.yaml'.
+        """
 
         metadata_path = f'{path}/metadata.yaml'
         checkpoint_path = f'{path}/clay-v1.5.ckpt'
+        encoder_checkpoint_path = f'{path}/{encoder_checkpoint_name}'
         constants_path = f'{path}/embeddings-constants.yaml'
 
-        if not os.path.isfile(metadata_path) or not os.path.isfile(checkpoint_path) or not os.path.isfile(constants_path):
-            raise ValueError(f"model path must contain the files 'metadata.yaml', 'embeddings-constants.yaml' and 'clay-v1.5.ckpt'")
+        if encoder_only and os.path.isfile(encoder_checkpoint_path):
+            checkpoint_path = encoder_checkpoint_path
+
+        # only the files used by the chosen way of running the encoder
+        required = [constants_path]
+        if backend is None:
+            required.append(checkpoint_path)
+            if not encoder_only:
+                # only read by the lightning module
+                required.append(metadata_path)
+        missing = [os.path.basename(f) for f in required if not os.path.isfile(f)]
+        if len(missing) > 0:
+            raise ValueError(f"model path must contain the files {', '.join(repr(f) for f in missing)}")
 
         with open(constants_path) as f:
             self.constants = yaml.load(f.read(), Loader=yaml.SafeLoader)
@@ -30,13 +80,52 @@ class ClayWrapper:
             torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
         )
 
+        self.path = path
         self.checkpoint_path = checkpoint_path
         self.metadata_path = metadata_path
 
         logger.info(f"using device {self.device}")
 
+        self.clay_model = None
+        self.encoder = None
+        self.backend = None
+        if backend is not None:
+            if not isinstance(backend, ExportedBackend):
+                logger.info(f"loading exported clay encoder for {backend}")
+                backend = backends[backend](self.exported_path(backend))
+            self.backend = backend
+            self.patch_size = backend.patch_size
+            self.embeddings_dim = backend.dim
+        else:
+            if encoder_only:
+                self.encoder = self._load_encoder(checkpoint_path)
+            else:
+                self.clay_model = self._load_clay_model(checkpoint_path, metadata_path)
+                self.encoder = self.clay_model.model.encoder
+            self.encoder.eval()
+            self.patch_size = self.encoder.patch_size
+            self.embeddings_dim = self.encoder.dim
+
+        # mean and stds for normalization of RGB channels
+        self.means = means
+        self.stds = stds
+        self._pixel_means = torch.tensor(means, dtype=torch.float32, device=self.device).view(1, 3, 1, 1)
+        self._pixel_stds = torch.tensor(stds, dtype=torch.float32, device=self.device).view(1, 3, 1, 1)
+
+        self.memory_budget = memory_budget
+        self._batch_sizes = {}  # (image_size, patch_stride) -> batch size
+
+        self._transformers = {"fp32": self.encoder.transformer} if self.encoder is not None else {}
+        self.set_precision(precision)
+
+        logger.info("done")
+
+    def _load_clay_model(self, checkpoint_path, metadata_path):
+        # lightning is only needed (and imported) for the full model
+        from .module import ClayMAEModule
+
         logger.info("creating clay model instance")
-        self.clay_model = ClayMAEModule(
+        clay_model = ClayMAEModule(
             model_size="large",
             mask_ratio=0.75,
             norm_pix_loss=False,
@@ -57,61 +146,474 @@ class ClayWrapper:
         z = torch.load(
             checkpoint_path, weights_only=False, map_location=torch.device(self.device)
         )
-        self.clay_model.load_state_dict(z["state_dict"])
+        clay_model.load_state_dict(z["state_dict"])
+        return clay_model
 
-        # mean and stds for normalization of RGB channels
-        self.means = means
-        self.stds = stds
+    def _load_encoder(self, checkpoint_path):
+        logger.info("creating clay encoder instance")
+        # parameters are created on the meta device (no memory, no random init)
+        # and replaced by the checkpoint tensors when loading the state dict
+        with torch.device("meta"):
+            encoder = clay_encoder_large(mask_ratio=0.75, patch_size=8, shuffle=True)
 
-        logger.info("done")
+        logger.info(f"loading clay encoder weights from {checkpoint_path}")
+        # mmap avoids reading the teacher and decoder tensors of the full checkpoint
+        z = torch.load(checkpoint_path, weights_only=False, mmap=True, map_location="cpu")
+        state_dict = {
+            k[len(encoder_prefix):]: v
+            for k, v in z["state_dict"].items()
+            if k.startswith(encoder_prefix)
+        }
+        if len(state_dict) == 0:
+            state_dict = z["state_dict"]  # already an encoder only checkpoint
+        encoder.load_state_dict(state_dict, assign=True)
+        return encoder.to(self.device)
+
+    def save_encoder_checkpoint(self, path):
+        """
+        saves only the encoder weights in 'path', so that it can later be used
+        with `encoder_only=True`. If 'path' is a folder the file is named
+        'clay-v1.5-encoder.ckpt'.
+        """
+        if os.path.isdir(path):
+            path = f'{path}/{encoder_checkpoint_name}'
+
+        state_dict = {
+            f'{encoder_prefix}{k}': v.detach().cpu()
+            for k, v in self.encoder.state_dict().items()
+        }
+        torch.save({"state_dict": state_dict}, path)
+        logger.info(f"saved clay encoder weights to {path}")
+        return path
+
+    def exported_path(self, format):
+        return f'{self.path}/{encoder_checkpoint_name[:-len(".ckpt")]}.{export_extensions[format]}'
+
+    def export(self, format="onnx", image_size=512, patch_stride=1, path=None):
+        """
+        exports the encoder inference path for images of 'image_size' (patch
+        embedding with the rgb wave kernel, position encodings, transformer,
+        mean pooling and standardization) to 'onnx' or 'torchscript'. the
+        transformer is always exported in fp32.
+
+        path: where to save it, by default in the model folder, where
+              `ClayWrapper(path, backend=format)` finds it.
+        """
+        if self.encoder is None:
+            raise ValueError("exported encoders cannot be exported again")
 
-    def batch_embeddings(self, batch, standardize=True):
+        path = path or self.exported_path(format)
+        inference_encoder = ClayInferenceEncoder(
+            self.encoder,
+            image_size=image_size,
+            embeddings_means=self.constants['means'],
+            embeddings_stds=self.constants['stds'],
+            patch_stride=patch_stride,
+            transformer=self._transformers["fp32"],
+        )
+        export_encoder(inference_encoder, path, format=format)
+        logger.info(f"exported clay encoder to {path}")
+        return path
+
+    def set_precision(self, precision):
+        """
+        precision: 'fp32', 'bf16' to run the encoder under bfloat16 autocast, or
+                   'int8' to use dynamically quantized int8 nn.Linear layers in
+                   the transformer (attention and feed forward), cpu only.
+        """
+        if precision not in precisions:
+            raise ValueError(f"precision must be one of {precisions}, but found '{precision}'")
+
+        if self.backend is not None:
+            if precision != "fp32":
+                raise ValueError("exported encoders only run in fp32")
+            self.precision = precision
+            return
+
+        if precision == "int8":
+            if self.device.type != "cpu":
+                raise ValueError("int8 precision is only available on cpu")
+            if "int8" not in self._transformers:
+                logger.info("quantizing clay transformer linear layers to int8")
+                self._transformers["int8"] = torch.ao.quantization.quantize_dynamic(
+                    self._transformers["fp32"], {nn.Linear}, dtype=torch.qint8, inplace=False
+                )
+            self.encoder.transformer = self._transformers["int8"]
+        else:
+            self.encoder.transformer = self._transformers["fp32"]
+
+        self.precision = precision
+
+    def _autocast(self):
+        if self.precision == "bf16":
+            return torch.autocast(device_type=self.device.type, dtype=torch.bfloat16)
+        return contextlib.nullcontext()
+
+    def precision_drift(self, batch, precisions=("bf16", "int8"), **kwargs):
         """
-        batch: [batch_size, 3, img_size, img_size]
-               the 3 is three channels for rgb
+        compares the embeddings of 'batch' computed with each precision against
+        those computed in fp32, to choose a precision with numbers in hand.
+        kwargs are passed to `batch_embeddings`.
 
-               the imgs are assumed to be ints in [0,255]
+        returns: a dict with, for fp32 and each precision
+                 'cosine_mean', 'cosine_min': cosine similarity with the fp32 embeddings
+                 'relative_error_mean', 'relative_error_max': |e - e_fp32| / |e_fp32|
+                 'max_abs_error': largest difference in any component
+                 'secs_per_image': time spent per image
+        """
+        current_precision = self.precision
+        batch = np.asarray(batch)
+        results = {}
+        try:
+            for precision in ("fp32",) + tuple(p for p in precisions if p != "fp32"):
+                self.set_precision(precision)
+                t0 = time.perf_counter()
+                e = self.batch_embeddings(batch, **kwargs).astype(np.float64)
+                secs = time.perf_counter() - t0
+                if precision == "fp32":
+                    reference = e
+
+                reference_norm = np.linalg.norm(reference, axis=1)
+                cosine = (e * reference).sum(axis=1) / (np.linalg.norm(e, axis=1) * reference_norm)
+                relative_error = np.linalg.norm(e - reference, axis=1) / reference_norm
+                results[precision] = {
+                    "cosine_mean": float(cosine.mean()),
+                    "cosine_min": float(cosine.min()),
+                    "relative_error_mean": float(relative_error.mean()),
+                    "relative_error_max": float(relative_error.max()),
+                    "max_abs_error": float(np.abs(e - reference).max()),
+                    "secs_per_image": secs / len(batch),
+                }
+                logger.info(f"precision {precision}: {results[precision]}")
+        finally:
+            self.set_precision(current_precision)
+
+        return results
+
+    def auto_batch_size(self, image_size, patch_stride=1):
+        """
+        largest number of images whose estimated memory footprint fits in
+        'self.memory_budget' (bytes). It is reduced after running out of memory.
+        """
+        key = (image_size, patch_stride)
+        if key not in self._batch_sizes:
+            grid_size = image_size // self.patch_size
+            tokens = (grid_size // patch_stride)**2 + 1
+            dim = self.embeddings_dim
+            # float32 pixels, full patch grid (patch embedding & encodings) and
+            # the largest transformer activations (~ qkv + mlp hidden + residual)
+            bytes_per_image = 4 * (3 * image_size**2 + 2 * grid_size**2 * dim + 10 * tokens * dim)
+            self._batch_sizes[key] = max(1, int(self.memory_budget // bytes_per_image))
+        return self._batch_sizes[key]
+
+    def batch_embeddings(self, batch, standardize=True, patch_stride=1, batch_size=None, channels_last=None):
+        """
+        batch: [n, 3, img_size, img_size] or [n, img_size, img_size, 3] (as the
+               'img' of the chips) of any size, or an iterable of such arrays
+               and/or of single images. the 3 is three channels for rgb
+
+               the imgs are assumed to be ints in [0,255], preferably uint8
 
         standardize: True to substract the dataset mean and divide by its stdev
+
+        patch_stride: 1 to use all image patches. Larger values use a fixed
+               subsample of the patch grid (one every 'patch_stride' patches
+               along each axis), faster but less accurate. In any case,
+               the same image always gets the same embedding.
+
+        batch_size: images sent to the model at once. If None, see `auto_batch_size`.
+
+        channels_last: True if channels are the last axis. If None, it is guessed
+               from the shape.
+
+        returns: [n, embeddings_dim]
+
+        these embeddings pool all the (or the 'patch_stride' lattice of) encoded
+        patches without masking, while the earlier ones pooled a random 25% of
+        them. image embeddings computed the old way (e.g. the 'image_embedding'
+        of the released 48k chips) are not comparable to them, and
+        'embeddings-constants.yaml' was fitted on the old distribution: both
+        must be regenerated (see `pipeline.embed_files`) before mixing them.
+        """
+        e = list(self.iter_batch_embeddings(batch, standardize, patch_stride, batch_size, channels_last))
+        if len(e) == 0:
+            return np.zeros((0, self.embeddings_dim))
+        return np.concatenate(e)
+
+    def iter_batch_embeddings(self, batch, standardize=True, patch_stride=1, batch_size=None, channels_last=None):
         """
+        same as `batch_embeddings`, but yields the embeddings of one chunk of
+        images at a time, so that only one chunk is normalized and in the
+        model at any moment.
+        """
+        def chunk_embeddings(chunk, channels_last):
+            return self._chunk_embeddings(chunk, standardize, patch_stride, channels_last)
 
-        def to_device(x, device):
-            return {
-                k: v.to(device) if isinstance(v, torch.Tensor) else v
-                for k, v in x.items()
-            }
+        yield from self._iter_chunks(batch, chunk_embeddings, patch_stride, batch_size, channels_last)
 
-        if not batch.shape[1] == 3:
-            raise ValueError(
-                f"expecting 3 channels (rgb), but found {batch.shape[1]}"
-            )
-        image_size = batch.shape[-1]
+    def batch_patch_embeddings(self, batch, pool=None, standardize=True, patch_stride=1,
+                               batch_size=None, channels_last=None, dtype=np.float16):
+        """
+        patch level embeddings, as a grid with the spatial layout of the images.
 
-        batch_normalized = np.transpose(
-            (np.transpose(batch, [0, 2, 3, 1]) - self.means) / self.stds, [0, 3, 1, 2]
-        )
+        batch, patch_stride, batch_size, channels_last: as in `batch_embeddings`
 
-        x = {
-            "pixels": torch.tensor(batch_normalized).type(torch.float),
-            "time": torch.zeros([len(batch_normalized), 4]),
-            "latlon": torch.zeros([len(batch_normalized), 4]),
-            "gsd": torch.tensor(10.0),
-            "waves": torch.tensor([1552.0, 1355.0, 1105.0]),
-        }  # rgb freqs
+        pool: None to return the full patch grid (img_size // patch_size //
+              patch_stride per side), or k to average it into k x k regions.
 
-        x = to_device(x, next(self.clay_model.parameters()).device)
+        standardize: True to standardize with the same constants as the image
+              embeddings, so that regions live in the same space as images (with
+              pool=1 the result is the image embedding).
 
-        with torch.no_grad():
-            embeddings_raw, *_ = self.clay_model.model.encoder(x)
+        dtype: of the result, float16 by default to store them compactly.
 
-        patch_size = self.clay_model.model.patch_size
-        # compute patch and image embeddings
-        patch_embeddings = rearrange(
-            embeddings_raw[:, :-1, :],  # :-1; last embedding is the cls_token
-            "b (h w) d -> b h w d",
-            w=image_size // patch_size // 2,
-            h=image_size // patch_size // 2,
+        returns: [n, h, w, embeddings_dim], h = w = pool if given
+        """
+        e = list(self.iter_batch_patch_embeddings(batch, pool, standardize, patch_stride,
+                                                  batch_size, channels_last, dtype))
+        if len(e) == 0:
+            size = pool or 0
+            return np.zeros((0, size, size, self.embeddings_dim), dtype=dtype)
+        return np.concatenate(e)
+
+    def iter_batch_patch_embeddings(self, batch, pool=None, standardize=True, patch_stride=1,
+                                    batch_size=None, channels_last=None, dtype=np.float16):
+        """
+        same as `batch_patch_embeddings`, but yields the results one chunk of images at a time.
+        """
+        if self.backend is not None:
+            raise ValueError("patch embeddings are not available with exported encoders")
+
+        def chunk_patch_embeddings(chunk, channels_last):
+            patch_grid = self._chunk_patch_grid(chunk, patch_stride, channels_last)
+            if pool is not None:
+                patch_grid = rearrange(
+                    F.adaptive_avg_pool2d(rearrange(patch_grid, "b h w d -> b d h w"), pool),
+                    "b d h w -> b h w d",
+                )
+            e = patch_grid.cpu().numpy()
+            if standardize:
+                e = (e - self.constants['means'])/self.constants['stds']
+            return e.astype(dtype)
+
+        yield from self._iter_chunks(batch, chunk_patch_embeddings, patch_stride, batch_size, channels_last)
+
+    def scene_embeddings(self, scene, chip_size=512, stride=None, standardize=True, patch_stride=1,
+                         batch_size=None, channels_last=None, transform=None):
+        """
+        embeddings of the tiles of a large scene, cut with a sliding window.
+
+        scene: [H, W, 3] or [3, H, W] array with ints in [0,255]. it can be a
+               np.memmap, only one row of tiles is read and normalized at a time.
+
+        chip_size: size of the tiles in pixels
+        stride: pixels between consecutive tiles, chip_size (no overlap) by default.
+               tiles not fitting entirely in the scene are left out.
+
+        standardize, patch_stride, batch_size, channels_last: as in `batch_embeddings`
+
+        transform: optional affine geotransform of the scene, in gdal order
+               (x_origin, pixel_width, row_rotation, y_origin, col_rotation, pixel_height),
+               to compute the geo coordinates of the tiles.
+
+        returns: embeddings [ny, nx, embeddings_dim]
+                 offsets [ny, nx, 2] (row, col) of the upper left pixel of each tile
+                 coords [ny, nx, 2] (x, y) of the upper left corner of each tile,
+                         None if no transform is given
+        """
+        rows = list(self.iter_scene_embeddings(scene, chip_size, stride, standardize, patch_stride,
+                                               batch_size, channels_last))
+        if len(rows) == 0:
+            embeddings = np.zeros((0, 0, self.embeddings_dim))
+            offsets = np.zeros((0, 0, 2), dtype=int)
+        else:
+            embeddings = np.stack([e for _, e, _ in rows])
+            offsets = np.stack([o for _, _, o in rows])
+
+        coords = None
+        if transform is not None:
+            x0, dx, rx, y0, ry, dy = transform
+            coords = np.stack([
+                x0 + offsets[..., 1] * dx + offsets[..., 0] * rx,
+                y0 + offsets[..., 1] * ry + offsets[..., 0] * dy,
+            ], axis=-1)
+
+        return embeddings, offsets, coords
+
+    def iter_scene_embeddings(self, scene, chip_size=512, stride=None, standardize=True, patch_stride=1,
+                              batch_size=None, channels_last=None):
+        """
+        same as `scene_embeddings`, but yields (i, embeddings [nx, embeddings_dim],
+        offsets [nx, 2]) for each row i of tiles, as they are computed.
+
+        when the stride is a multiple of the patch size, the patch embedding of
+        each row of tiles is computed once per window of a batch of tiles of its
+        band of the scene, and the tiles are sliced from it, so overlapping tiles
+        share that work (the transformer still runs once per tile, since
+        attention is global).
+        """
+        stride = stride or chip_size
+        channels_last, _ = image_layout(scene.shape, channels_last)
+        if not channels_last:
+            scene = scene.transpose(1, 2, 0)  # a view, [H W 3]
+
+        height, width, _ = scene.shape
+        ys = range(0, height - chip_size + 1, stride)
+        xs = np.arange(0, width - chip_size + 1, stride)
+        if len(xs) == 0:
+            return
+
+        shared_patches = (
+            self.encoder is not None
+            and stride % self.patch_size == 0
+            and chip_size % self.patch_size == 0
         )
+
+        for i, y in enumerate(ys):
+            band = scene[y:y + chip_size, :xs[-1] + chip_size]  # [chip_size W' 3]
+            if shared_patches:
+                e = self._band_embeddings(band, xs, chip_size, standardize, patch_stride, batch_size)
+            else:
+                e = self.batch_embeddings(
+                    [band[:, x:x + chip_size] for x in xs],
+                    standardize=standardize,
+                    patch_stride=patch_stride,
+                    batch_size=batch_size,
+                    channels_last=True,
+                )
+            offsets = np.stack([np.full(len(xs), y), xs], axis=-1)
+            yield i, e, offsets
+
+    def _band_embeddings(self, band, xs, chip_size, standardize, patch_stride, batch_size):
+        """
+        embeddings of the tiles at columns xs of a band of the scene. the band is
+        patch embedded in windows of up to a batch of tiles (overlapping by
+        chip_size - stride), whose tiles share that patch embedding.
+        """
+        tile_patches = chip_size // self.patch_size
+
+        def tiles_embeddings(cols):
+            x0 = cols[0]
+            x = self.normalize(band[np.newaxis, :, x0:cols[-1] + chip_size], channels_last=True)  # [1 3 chip_size w]
+            with torch.no_grad(), self._autocast():
+                patches, _ = self.encoder.to_patch_embed(
+                    x, torch.tensor([1552.0, 1355.0, 1105.0])
+                )  # [1 L D], rgb freqs
+            patch_grid = rearrange(patches, "1 (h w) d -> h w d", h=tile_patches)
+
+            tiles = torch.stack([
+                patch_grid[:, c:c + tile_patches] for c in (cols - x0) // self.patch_size
+            ])  # [b h w D]
+            tiles = rearrange(tiles, "b h w d -> b (h w) d")
+            zeros = torch.zeros([len(cols), 4], device=self.device)
+            with torch.no_grad(), self._autocast():
+                tiles = self.encoder.add_encodings(tiles, zeros, zeros, torch.tensor(10.0))
+                _, tiles_grid = self.encoder.encode_patches(tiles, patch_stride=patch_stride)
+
+            e = reduce(tiles_grid.float(), "b h w d -> b d", "mean").cpu().numpy()
+            if standardize:
+                e = (e - self.constants['means'])/self.constants['stds']
+            return e
+
+        key = (chip_size, patch_stride)
+        if batch_size is None:
+            self.auto_batch_size(chip_size, patch_stride)
+            batch_sizes = self._batch_sizes
+        else:
+            batch_sizes = {key: batch_size}
+
+        e = []
+        i = 0
+        while i < len(xs):
+            cols = xs[i:i + batch_sizes[key]]
+            e.append(self._with_oom_backoff(tiles_embeddings, cols, batch_sizes, key))
+            i += len(cols)
+        return np.concatenate(e)
+
+    def _iter_chunks(self, batch, fn, patch_stride, batch_size, channels_last):
+        """yields fn(chunk, channels_last) for the chunks of images in batch"""
+        if not isinstance(batch, np.ndarray):
+            batch = iter(batch)
+            first = next(batch, None)
+            if first is None:
+                return
+            batch = itertools.chain([first], batch)
+            channels_last, image_size = image_layout(np.shape(first), channels_last)
+        else:
+            channels_last, image_size = image_layout(batch.shape, channels_last)
+
+        # explicit batch sizes are only reduced for this call, automatic
+        # ones are remembered for later calls
+        key = (image_size, patch_stride)
+        if batch_size is None:
+            self.auto_batch_size(image_size, patch_stride)
+            batch_sizes = self._batch_sizes
+        else:
+            batch_sizes = {key: batch_size}
+
+        def chunk_fn(chunk):
+            return fn(chunk, channels_last)
+
+        for chunk in iter_chunks(batch, lambda: batch_sizes[key]):
+            yield self._with_oom_backoff(chunk_fn, chunk, batch_sizes, key)
+
+    def _with_oom_backoff(self, fn, chunk, batch_sizes, key):
+        """fn(chunk), splitting chunk in halves while running out of memory"""
+        try:
+            return fn(chunk)
+        except (RuntimeError, MemoryError) as e:
+            if not is_out_of_memory(e) or len(chunk) == 1:
+                raise
+
+            half = len(chunk) // 2
+            batch_sizes[key] = min(batch_sizes[key], half)
+            logger.warning(f"out of memory with {len(chunk)} images, reducing batch size to {batch_sizes[key]}")
+            if self.device.type == "cuda":
+                torch.cuda.empty_cache()
+
+            return np.concatenate([
+                self._with_oom_backoff(fn, chunk[:half], batch_sizes, key),
+                self._with_oom_backoff(fn, chunk[half:], batch_sizes, key),
+            ])
+
+    def normalize(self, batch, channels_last):
+        """
+        batch: [n, img_size, img_size, 3] if channels_last else [n, 3, img_size, img_size]
+
+        returns: float32 normalized tensor [n, 3, img_size, img_size] in the model
+                 device. the only copy of the pixels is the conversion to float32,
+                 done in the device. transposing channels_last images is just a
+                 view (the tensor keeps a channels_last memory format).
+        """
+        with warnings.catch_warnings():
+            # read only arrays (e.g. memmaps) are never written to
+            warnings.filterwarnings("ignore", message="The given NumPy array is not writable")
+            x = torch.from_numpy(batch)
+
+        if channels_last:
+            x = x.permute(0, 3, 1, 2)
+
+        if self.device.type == "cpu":
+            x = x.to(torch.float32, copy=True)
+        else:
+            x = x.to(self.device).to(torch.float32)
+
+        return x.sub_(self._pixel_means).div_(self._pixel_stds)
+
+    def _chunk_embeddings(self, batch, standardize, patch_stride, channels_last):
+
+        if self.backend is not None:
+            _, image_size = image_layout(batch.shape, channels_last)
+            if image_size != self.backend.image_size or patch_stride != self.backend.patch_stride:
+                raise ValueError(
+                    f"the exported encoder expects images of size {self.backend.image_size} "
+                    f"and patch_stride {self.backend.patch_stride}"
+                )
+            e, e_raw = self.backend(self.normalize(batch, channels_last))
+            return e if standardize else e_raw
+
+        patch_embeddings = self._chunk_patch_grid(batch, patch_stride, channels_last)
+
         # image embeddings
         e = reduce(patch_embeddings, "b h w d -> b d", "mean").cpu().numpy()
 
@@ -119,3 +621,72 @@ class ClayWrapper:
         if standardize:
             e = (e - self.constants['means'])/self.constants['stds']
         return e
+
+    def _chunk_patch_grid(self, batch, patch_stride, channels_last):
+        """float32 tensor [b h w d] with the encoded patches of the images in batch"""
+
+        x = {
+            "pixels": self.normalize(batch, channels_last),
+            "time": torch.zeros([len(batch), 4], device=self.device),
+            "latlon": torch.zeros([len(batch), 4], device=self.device),
+            "gsd": torch.tensor(10.0),
+            "waves": torch.tensor([1552.0, 1355.0, 1105.0]),
+        }  # rgb freqs
+
+        # no masking, all patches in their original order
+        with torch.no_grad(), self._autocast():
+            _, patch_embeddings = self.encoder.encode(x, patch_stride=patch_stride)
+
+        return patch_embeddings.float()
+
+
+def image_layout(shape, channels_last=None):
+    """
+    (channels_last, image_size) for the shape of an rgb image or batch of images
+    """
+    if channels_last is None:
+        channels_last = shape[-1] == 3 and shape[-3] != 3
+    channels = shape[-1] if channels_last else shape[-3]
+    if channels != 3:
+        raise ValueError(
+            f"expecting 3 channels (rgb), but found {channels}"
+        )
+    return channels_last, shape[-2]
+
+
+def iter_chunks(batch, batch_size):
+    """
+    yields arrays with the images in 'batch' (an array or an iterable of single
+    images and/or arrays of images), with at most batch_size() images each.
+    arrays are sliced, not copied.
+    """
+    if isinstance(batch, np.ndarray):
+        i = 0
+        while i < len(batch):
+            n = batch_size()
+            yield batch[i:i + n]
+            i += n
+        return
+
+    buffer, buffered = [], 0
+    for b in batch:
+        b = np.asarray(b)
+        if b.ndim == 3:
+            b = b[np.newaxis]
+        buffer.append(b)
+        buffered += len(b)
+        while buffered >= batch_size():
+            chunk = np.concatenate(buffer) if len(buffer) > 1 else buffer[0]
+            n = batch_size()
+            yield chunk[:n]
+            buffer, buffered = [chunk[n:]], len(chunk) - n
+
+    if buffered > 0:
+        yield np.concatenate(buffer) if len(buffer) > 1 else buffer[0]
+
+
+def is_out_of_memory(e):
+    if isinstance(e, MemoryError) or isinstance(e, torch.cuda.OutOfMemoryError):
+        return True
+    msg = str(e)
+    return "out of memory" in msg or "can't allocate memory" in msg
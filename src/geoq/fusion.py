@@ -0,0 +1,120 @@
+"""Hybrid search over the text and image embeddings of the chips: a
+shortlist is found with a full scan of one space, only the shortlist is
+scored in the other one, and both rankings are fused.
+"""
+
+import numpy as np
+
+from .search import SearchEngine, candidate_distances
+
+fusion_methods = ("rrf", "weighted")
+
+
+class FusionSearch:
+
+    def __init__(self, text_vectors, image_vectors, primary='text', block_size=16384):
+        """
+        text_vectors, image_vectors: [n, dim_text] and [n, dim_image] embeddings
+              of the same chips, e.g. `ChipStore.text_embedding` and
+              `ChipStore.image_embedding`.
+        primary: 'text' or 'image', the space fully scanned to build the
+              shortlist. the other one is only scored on the shortlist.
+        """
+        if len(text_vectors) != len(image_vectors):
+            raise ValueError(f"got {len(text_vectors)} text embeddings but {len(image_vectors)} image embeddings")
+        if primary not in ('text', 'image'):
+            raise ValueError(f"primary must be 'text' or 'image', but found '{primary}'")
+
+        self.vectors = {'text': text_vectors, 'image': image_vectors}
+        self.primary = primary
+        self.secondary = 'image' if primary == 'text' else 'text'
+        self.engine = SearchEngine(self.vectors[primary], block_size=block_size)
+
+    @classmethod
+    def from_store(cls, store, primary='text', block_size=16384):
+        return cls(store.text_embedding, store.image_embedding, primary=primary, block_size=block_size)
+
+    def __len__(self):
+        return len(self.vectors['text'])
+
+    def search(  # noqa: PLR0913
+        self,
+        text_queries,
+        image_queries,
+        k=10,
+        shortlist=100,
+        method='rrf',
+        text_weight=0.5,
+        rrf_k=60,
+        rows=None,
+    ):
+        """
+        text_queries: [n_queries, dim_text] (or [dim_text] for a single query)
+        image_queries: [n_queries, dim_image], the same queries in the image space
+        k: number of chips for each query
+        shortlist: number of candidates taken from the primary space, scored
+              in both spaces
+        method: how the two rankings of the shortlist are fused
+              'rrf': reciprocal rank fusion, sum of 1 / (rrf_k + rank)
+              'weighted': text_weight * text + (1 - text_weight) * image of
+                  the distances min-max scaled over the shortlist of each query
+        rows: optional subset of rows to search in (e.g. from `GridIndex.rows_in`)
+
+        returns: scores [n_queries, k] (higher is better) and rows [n_queries, k]
+                 of the chips, -1 where there are less than k candidates.
+        """
+        if method not in fusion_methods:
+            raise ValueError(f"method must be one of {fusion_methods}, but found '{method}'")
+
+        queries = {
+            'text': np.asarray(text_queries, dtype=np.float32),
+            'image': np.asarray(image_queries, dtype=np.float32),
+        }
+        single = queries['text'].ndim == 1
+        queries = {space: np.atleast_2d(q) for space, q in queries.items()}
+        if len(queries['text']) != len(queries['image']):
+            raise ValueError(f"got {len(queries['text'])} text queries but {len(queries['image'])} image queries")
+
+        shortlist = max(shortlist, k)
+        primary_d, candidates = self.engine.search(queries[self.primary], k=shortlist, rows=rows)
+        secondary_d = candidate_distances(queries[self.secondary], candidates, self.vectors[self.secondary])
+        distances = {self.primary: primary_d, self.secondary: secondary_d}
+
+        if method == 'rrf':
+            scores = rrf_scores(distances['text'], rrf_k) + rrf_scores(distances['image'], rrf_k)
+        else:
+            scores = (
+                text_weight * (1 - minmax_scale(distances['text']))
+                + (1 - text_weight) * (1 - minmax_scale(distances['image']))
+            )
+        scores[candidates < 0] = -np.inf
+
+        top = np.argsort(-scores, axis=1, kind='stable')[:, :k]
+        scores = np.take_along_axis(scores, top, axis=1)
+        rows = np.take_along_axis(candidates, top, axis=1)
+        rows[~np.isfinite(scores)] = -1
+
+        if single:
+            return scores[0], rows[0]
+        return scores, rows
+
+
+def rrf_scores(distances, rrf_k=60):
+    """
+    reciprocal rank fusion scores 1 / (rrf_k + rank) of the columns of
+    [n_queries, n] distances, 0 for infinite (missing) distances.
+    """
+    ranks = np.argsort(np.argsort(distances, axis=1, kind='stable'), axis=1) + 1
+    scores = 1 / (rrf_k + ranks)
+    scores[~np.isfinite(distances)] = 0
+    return scores
+
+
+def minmax_scale(distances):
+    """distances scaled to [0, 1] per row, missing (infinite) ones to 1"""
+    finite = np.isfinite(distances)
+    lo = np.where(finite, distances, np.inf).min(axis=1, keepdims=True)
+    hi = np.where(finite, distances, -np.inf).max(axis=1, keepdims=True)
+    with np.errstate(invalid='ignore'):
+        scaled = (distances - lo) / np.where(hi > lo, hi - lo, 1)
+    return np.where(finite, scaled, 1)
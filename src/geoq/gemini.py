@@ -1,3 +1,6 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 import os
 import tempfile
 from skimage import io
@@ -7,8 +10,15 @@ import numpy as np
 import json
 from loguru import logger
 import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions
 from time import sleep
 
+from .cache import EmbeddingCache
+from .ratelimit import estimate_tokens
+
+# tokens counted by gemini for an image in a prompt
+image_tokens = 258
+
 best_gemini_generation_prompt = '''
 You are analyzing a satellite image to create a comprehensive textual description for precise image retrieval from a vast da
 tabase.  Your description will serve as a detailed visual fingerprint, enabling users to pinpoint this specific image among 
@@ -79,9 +89,17 @@ class GeminiMultimodalModel:
                  temperature = 1,   
                  top_p = 0.95,       
                  max_output_tokens = 8192,
-                 verbose = False):
+                 verbose = False,
+                 embeddings_cache = None,
+                 rate_limiter = None):
         """
         api_key: string with the api key of the file name to read it from
+        embeddings_cache: an EmbeddingCache, or the path of its SQLite file, to reuse
+                          the embeddings of texts already seen. None for no cache.
+        rate_limiter: a RateLimiter shared by all the calls to gemini (possibly from other
+                      processes, see RateLimiter.path). when given, calls wait for the quota
+                      and calls failed with quota or server errors back off with jitter
+                      instead of sleeping sleep_secs_before_retry.
         """
 
         super().__init__()
@@ -94,6 +112,11 @@ class GeminiMultimodalModel:
         self.verbose               = verbose
         self.api_key               = api_key
         self.generation_prompt     = best_gemini_generation_prompt
+
+        if isinstance(embeddings_cache, str):
+            embeddings_cache = EmbeddingCache(embeddings_cache)
+        self.embeddings_cache      = embeddings_cache
+        self.rate_limiter          = rate_limiter
         
 
         # Configure the Gemini API
@@ -134,19 +157,48 @@ class GeminiMultimodalModel:
     def set_generation_prompt(self, prompt):
         self.generation_prompt = prompt
 
+    def _upload_image(self, img):
+        """uploads img to gemini so that it can be part of a prompt"""
+        with tempfile.TemporaryDirectory() as tmp:
+            img_path = os.path.join(tmp, 'img.jpg')
+            io.imsave(img_path, img)
+            uploaded_img_path = genai.upload_file(img_path, mime_type=None)
+            if self.verbose: 
+                logger.info(f"uploaded file image to prompt")
+        return uploaded_img_path
+
+    def _max_tokens_per_call(self):
+        """tokens a single call can take from the rate limiter, None for no limit"""
+        if self.rate_limiter is None:
+            return None
+        return self.rate_limiter.tokens_per_minute
+
+    def _wait_for_quota(self, tokens):
+        if self.rate_limiter is not None:
+            # a single text over the whole quota waits for a full bucket, the API decides
+            max_tokens = self._max_tokens_per_call()
+            self.rate_limiter.acquire(min(tokens, max_tokens) if max_tokens else tokens)
+
+    def _call_succeeded(self):
+        if self.rate_limiter is not None:
+            self.rate_limiter.report_success()
+
+    def _retry_sleep_secs(self, sleep_secs_before_retry, e):
+        """secs to sleep before retrying a call failed with 'e', None for no sleep"""
+        if self.rate_limiter is not None and is_quota_error(e):
+            # the backoff is enforced by the next acquire, in all processes
+            self.rate_limiter.report_error()
+            return None
+        return sleep_secs_before_retry
+
     def generate_description_for_image(self, img, max_retries=5, sleep_secs_before_retry=30):
 
         attempts = 0
         while True:
+            self._wait_for_quota(estimate_tokens(self.generation_prompt) + image_tokens)
             try:
 
-                # uploads img to gemini so that it is part of the prompt
-                with tempfile.TemporaryDirectory() as tmp:
-                    img_path = os.path.join(tmp, 'img.jpg')
-                    io.imsave(img_path, img)
-                    uploaded_img_path = genai.upload_file(img_path, mime_type=None)
-                    if self.verbose: 
-                        logger.info(f"uploaded file image to prompt")
+                uploaded_img_path = self._upload_image(img)
                 
                 if self.verbose:
                     logger.info('querying gemini for description')
@@ -157,6 +209,7 @@ class GeminiMultimodalModel:
                 )
                 prompt = self.generation_prompt
                 response = chat_session.send_message(prompt)
+                self._call_succeeded()
                 
                 return response.text
 
@@ -165,34 +218,286 @@ class GeminiMultimodalModel:
                     logger.error(f'attempt {attempts+1}, exception {str(e)}')
 
                 attempts += 1
-                if attempts > max_retries:
+                if attempts > max_retries or is_fatal_error(e):
                     return f'<!!error!!>::<!!pending!!>:::\n\n{str(e)}'
 
-                if sleep_secs_before_retry is not None:
-                    sleep(sleep_secs_before_retry)
+                sleep_secs = self._retry_sleep_secs(sleep_secs_before_retry, e)
+                if sleep_secs is not None:
+                    sleep(sleep_secs)
+
+    async def generate_description_for_image_async(self, img, max_retries=5, sleep_secs_before_retry=30, executor=None):
+        """
+        same as generate_description_for_image, but without blocking the event loop:
+        the image is saved and uploaded in a thread, and the chat message is sent
+        asynchronously. so one process can keep many requests in flight, see
+        generate_descriptions.
+
+        executor: thread pool for the upload, the default asyncio one if None.
+        """
+
+        attempts = 0
+        while True:
+            if self.rate_limiter is not None:
+                await self.rate_limiter.acquire_async(estimate_tokens(self.generation_prompt) + image_tokens)
+            try:
+
+                uploaded_img_path = await asyncio.get_running_loop().run_in_executor(executor, self._upload_image, img)
+
+                chat_session = self.generation_model.start_chat(
+                history=[
+                    {"role": "user", "parts": [uploaded_img_path]},
+                ]
+                )
+                response = await chat_session.send_message_async(self.generation_prompt)
+                self._call_succeeded()
+
+                return response.text
+
+            except Exception as e:
+                if self.verbose:
+                    logger.error(f'attempt {attempts+1}, exception {str(e)}')
+
+                attempts += 1
+                if attempts > max_retries or is_fatal_error(e):
+                    return f'<!!error!!>::<!!pending!!>:::\n\n{str(e)}'
+
+                sleep_secs = self._retry_sleep_secs(sleep_secs_before_retry, e)
+                if sleep_secs is not None:
+                    await asyncio.sleep(sleep_secs)
 
 
     def get_embedding(self, text, max_retries=5, sleep_secs_before_retry=10, task_type="RETRIEVAL_DOCUMENT"):
-    
+
+        if self.embeddings_cache is not None:
+            embedding = self.embeddings_cache.get(EmbeddingCache.key(self.embeddings_model_name, task_type, text))
+            if embedding is not None:
+                return embedding.copy()
+
+        return self._embed_text(text, max_retries, sleep_secs_before_retry, task_type)
+
+    def _embed_text(self, text, max_retries, sleep_secs_before_retry, task_type):
+        """same as get_embedding, without looking up the cache (but filling it)"""
+
         attempts = 0
         while True:
+            self._wait_for_quota(estimate_tokens(text))
             try:
                 result = genai.embed_content(
                             model=self.embeddings_model_name,
                             content=text,
                             task_type=task_type
                         )
-                return np.r_[result['embedding']]
+                embedding = np.r_[result['embedding']]
+                self._call_succeeded()
+                if self.embeddings_cache is not None:
+                    self.embeddings_cache.put(EmbeddingCache.key(self.embeddings_model_name, task_type, text), embedding)
+                # a copy, so that changing it in place does not change the cached one
+                return embedding.copy()
 
             except Exception as e:
                 attempts += 1
-                if attempts > max_retries:
+                if attempts > max_retries or is_fatal_error(e):
                     return f'TEXT:::{text}:::fdl2025\n\n{str(e)}'
 
-                if sleep_secs_before_retry is not None:
-                    sleep(sleep_secs_before_retry)
+                sleep_secs = self._retry_sleep_secs(sleep_secs_before_retry, e)
+                if sleep_secs is not None:
+                    sleep(sleep_secs)
 
+    def get_embeddings(self, texts, batch_size=100, max_retries=5, sleep_secs_before_retry=10, task_type="RETRIEVAL_DOCUMENT"):
+        """
+        embeddings of many texts, sending up to 'batch_size' texts per request
+        (100 is the API limit) instead of one request per text.
 
+        a batch rejected for its content (too large, an offending text) is split
+        in halves and each half is sent again, down to single texts, which are
+        retried as in get_embedding. so it only costs a few more requests.
+        a batch failing for other reasons (quota, server errors) is retried
+        whole after sleeping, up to max_retries, and its texts fail together.
 
+        returns: float32 array [len(texts), dim] aligned with 'texts', with NaN
+                 rows for the texts whose embedding failed.
+        """
+        texts = list(texts)
+        embeddings = [None] * len(texts)
+
+        if self.embeddings_cache is not None:
+            for i, text in enumerate(texts):
+                embedding = self.embeddings_cache.get(EmbeddingCache.key(self.embeddings_model_name, task_type, text))
+                if embedding is not None:
+                    embeddings[i] = embedding
+
+        missing = [i for i, e in enumerate(embeddings) if e is None]
+        for start in range(0, len(missing), batch_size):
+            batch = missing[start:start + batch_size]
+            batch_embeddings = self._embed_batch([texts[i] for i in batch], max_retries, sleep_secs_before_retry, task_type)
+            for i, embedding in zip(batch, batch_embeddings):
+                embeddings[i] = embedding
+
+            if self.verbose:
+                logger.info(f'embedded {min(start + batch_size, len(missing))}/{len(missing)} texts')
+
+        dim = next((len(e) for e in embeddings if not isinstance(e, str)), 0)
+        result = np.full((len(texts), dim), np.nan, dtype=np.float32)
+        for i, embedding in enumerate(embeddings):
+            if not isinstance(embedding, str):
+                result[i] = embedding
+        return result
+
+    def _embed_batch(self, texts, max_retries, sleep_secs_before_retry, task_type):
+        """
+        list of embeddings for 'texts' (error strings for the failed ones).
+        errors caused by the batch itself (too large, an invalid text) split it
+        in halves, other errors (quota, server) retry the whole batch after
+        sleeping, and fail it after max_retries.
+        """
+
+        if len(texts) == 1:
+            # already looked up in the cache by get_embeddings
+            return [self._embed_text(texts[0], max_retries, sleep_secs_before_retry, task_type)]
+
+        max_tokens = self._max_tokens_per_call()
+        if max_tokens and sum(estimate_tokens(t) for t in texts) > max_tokens:
+            # split before asking the rate limiter, which cannot grant more than its capacity
+            half = len(texts) // 2
+            return (
+                self._embed_batch(texts[:half], max_retries, sleep_secs_before_retry, task_type)
+                + self._embed_batch(texts[half:], max_retries, sleep_secs_before_retry, task_type)
+            )
+
+        attempts = 0
+        while True:
+            self._wait_for_quota(sum(estimate_tokens(t) for t in texts))
+            try:
+                result = genai.embed_content(
+                            model=self.embeddings_model_name,
+                            content=texts,
+                            task_type=task_type
+                        )
+                embeddings = [np.r_[e] for e in result['embedding']]
+                if len(embeddings) != len(texts):
+                    raise BatchLengthError(f'got {len(embeddings)} embeddings for {len(texts)} texts')
+                self._call_succeeded()
+                break
+
+            except Exception as e:
+                if is_batch_error(e):
+                    if self.verbose:
+                        logger.error(f'batch of {len(texts)} texts failed, splitting it. exception {str(e)}')
+                    half = len(texts) // 2
+                    return (
+                        self._embed_batch(texts[:half], max_retries, sleep_secs_before_retry, task_type)
+                        + self._embed_batch(texts[half:], max_retries, sleep_secs_before_retry, task_type)
+                    )
+
+                if self.verbose:
+                    logger.error(f'batch of {len(texts)} texts, attempt {attempts+1}, exception {str(e)}')
+
+                attempts += 1
+                if attempts > max_retries or is_fatal_error(e):
+                    return [f'TEXT:::{text}:::fdl2025\n\n{str(e)}' for text in texts]
+
+                sleep_secs = self._retry_sleep_secs(sleep_secs_before_retry, e)
+                if sleep_secs is not None:
+                    sleep(sleep_secs)
 
+        if self.embeddings_cache is not None:
+            for text, embedding in zip(texts, embeddings):
+                self.embeddings_cache.put(EmbeddingCache.key(self.embeddings_model_name, task_type, text), embedding)
+        return embeddings
 
+
+class BatchLengthError(ValueError):
+    """the API returned a different number of embeddings than texts sent"""
+
+
+def is_batch_error(e):
+    """
+    True for the errors caused by the content of a request (400 invalid
+    argument, 413 too large, or a mismatched response), which splitting the
+    batch can fix. quota, auth, not found and server errors are not.
+    """
+    if isinstance(e, (BatchLengthError, google_exceptions.BadRequest)):
+        return True
+    return isinstance(e, google_exceptions.ClientError) and e.code == 413
+
+
+def is_fatal_error(e):
+    """True for the errors that no retry can fix: bad or revoked api key, wrong model name"""
+    return isinstance(e, (google_exceptions.Unauthorized, google_exceptions.Forbidden, google_exceptions.NotFound))
+
+
+def is_quota_error(e):
+    """True for quota (429) and server errors, which the rate limiter backs off from"""
+    return isinstance(e, (google_exceptions.TooManyRequests, google_exceptions.ServerError))
+
+
+def location_section(geocode):
+    """markdown section with a reverse geocoding result, appended to the descriptions"""
+    return f"""
+### Geographical location
+```json
+{json.dumps(geocode, indent=4)}
+```
+    """
+
+
+async def generate_descriptions(model, items, max_in_flight=32, geocoder=None, **kwargs):
+    """
+    generates the descriptions of many images with a single GeminiMultimodalModel,
+    keeping up to 'max_in_flight' requests running at once.
+
+    items: iterable of (key, img), e.g. a generator reading the chips, so that
+           images are only read when a slot frees up. (key, img, (lon, lat))
+           when a geocoder is given.
+    geocoder: a Geocoder shared by all the items. if given, the reverse geocoding
+              of each chip is appended to its description as in location_section,
+              or left out (and logged) if it fails.
+    kwargs: passed to generate_description_for_image_async
+
+    yields (key, description) as soon as each description is ready, so not
+    in the order of 'items'. usage:
+
+        async for chip_id, description in generate_descriptions(gem, chips()):
+            ...
+    """
+
+    items = iter(items)
+    in_flight = {}
+    loop = asyncio.get_running_loop()
+    # the default executor has fewer threads than the uploads in flight
+    executor = ThreadPoolExecutor(max_workers=max_in_flight)
+
+    async def describe(img, lonlat):
+        description = await model.generate_description_for_image_async(img, executor=executor, **kwargs)
+        if geocoder is not None and '<!!error!!>' not in description:
+            # a failed geocoding (no results in open ocean, quota, no lonlat)
+            # only loses the location section, not the description
+            try:
+                lon, lat = lonlat
+                geocode = await loop.run_in_executor(executor, partial(geocoder.reverse_geocode, lat=lat, lon=lon))
+                description += location_section(geocode)
+            except Exception as e:
+                logger.error(f'geocoding failed for lonlat {lonlat}, exception {str(e)}')
+        return description
+
+    def submit():
+        for key, img, *rest in items:
+            task = asyncio.create_task(describe(img, rest[0] if rest else None))
+            in_flight[task] = key
+            return True
+        return False
+
+    try:
+        while len(in_flight) < max_in_flight and submit():
+            pass
+
+        while len(in_flight) > 0:
+            done, _ = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                key = in_flight.pop(task)
+                submit()
+                yield key, task.result()
+    finally:
+        for task in in_flight:
+            task.cancel()
+        executor.shutdown(wait=False)
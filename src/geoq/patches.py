@@ -0,0 +1,121 @@
+import numpy as np
+import pandas as pd
+
+from .search import SearchEngine
+
+
+class PatchIndex:
+
+    def __init__(self, chip_size=512, block_size=65536):
+        """
+        search index over regional embeddings of chips (patch grids pooled to
+        k x k regions, see `ClayWrapper.batch_patch_embeddings`), to find sub
+        areas inside chips without running the model again for each query.
+
+        chip_size: size in pixels of the chips, to report the pixel window of
+              each region within its chip.
+        block_size: number of regions whose distances to the queries are
+              computed at once, which bounds the memory used by a search.
+        """
+        self.chip_size = chip_size
+        self.block_size = block_size
+        self.grid_size = None
+        self.chip_ids = np.zeros(0, dtype=object)
+        self.vectors = None
+        self.engine = None
+        self._chip_ids = []
+        self._regions = []
+        self._pending = False
+
+    def _build(self):
+        """concatenates the regions added so far into a single matrix"""
+        if not self._pending:
+            return
+
+        self.chip_ids = np.concatenate(self._chip_ids)
+        regions = np.concatenate(self._regions)
+        self._chip_ids, self._regions = [self.chip_ids], [regions]
+
+        n, _, _, dim = regions.shape
+        self.vectors = regions.reshape(n * self.grid_size**2, dim)
+        self.engine = SearchEngine(self.vectors, block_size=self.block_size)
+        self._pending = False
+
+    def add(self, chip_ids, regions):
+        """
+        chip_ids: [n] identifiers of the chips
+        regions: [n, k, k, embeddings_dim] regional embeddings, kept in their
+                 dtype (float16 from `batch_patch_embeddings`)
+        """
+        if len(chip_ids) != len(regions):
+            raise ValueError(f"got {len(chip_ids)} chip ids but {len(regions)} chips")
+        if self.grid_size is not None and regions.shape[1:3] != (self.grid_size, self.grid_size):
+            raise ValueError(f"expecting {self.grid_size}x{self.grid_size} regions per chip, but found {regions.shape[1:3]}")
+
+        self.grid_size = regions.shape[1]
+        self._chip_ids.append(np.asarray(chip_ids, dtype=object))
+        self._regions.append(np.asarray(regions))
+        self._pending = True
+        return self
+
+    def __len__(self):
+        """number of chips"""
+        return sum(len(c) for c in self._chip_ids)
+
+    def search(self, query, n=10):
+        """
+        query: [embeddings_dim] or [q, embeddings_dim], in the same space as the regions
+        n: number of regions to return for each query
+
+        returns: for each query a DataFrame sorted by squared euclidean distance, with
+                 the chip_id, the row and col of the region in the chip grid, the
+                 pixel window (y0, x0, y1, x1) of the region within the chip
+                 and the distance. a single DataFrame if query is [embeddings_dim].
+        """
+        self._build()
+        if self.vectors is None:
+            raise ValueError("the index is empty")
+
+        query = np.asarray(query, dtype=np.float32)
+        single = query.ndim == 1
+        best_d, best_i = self.engine.search(np.atleast_2d(query), k=min(n, len(self.vectors)))
+
+        results = [self._describe(i, d) for i, d in zip(best_i, best_d)]
+        return results[0] if single else results
+
+    def _describe(self, idxs, distances):
+        # -1 when there are less valid regions than asked for
+        found = idxs >= 0
+        idxs, distances = idxs[found], distances[found]
+        regions_per_chip = self.grid_size**2
+        chip, cell = np.divmod(idxs, regions_per_chip)
+        row, col = np.divmod(cell, self.grid_size)
+        region_size = self.chip_size / self.grid_size
+        return pd.DataFrame({
+            'chip_id': self.chip_ids[chip],
+            'row': row,
+            'col': col,
+            'y0': (row * region_size).astype(int),
+            'x0': (col * region_size).astype(int),
+            'y1': ((row + 1) * region_size).astype(int),
+            'x1': ((col + 1) * region_size).astype(int),
+            'distance': distances,
+        })
+
+    def save(self, path):
+        """saves the index to a .npz file"""
+        self._build()
+        np.savez(
+            path,
+            chip_ids=self.chip_ids.astype(str),
+            regions=self._regions[0] if len(self._regions) > 0 else np.zeros((0, 0, 0, 0), dtype=np.float16),
+            chip_size=self.chip_size,
+        )
+
+    @classmethod
+    def load(cls, path, block_size=65536):
+        z = np.load(path)
+        index = cls(chip_size=int(z['chip_size']), block_size=block_size)
+        if len(z['chip_ids']) > 0:
+            index.add(z['chip_ids'], z['regions'])
+        return index
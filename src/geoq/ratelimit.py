@@ -0,0 +1,176 @@
+"""Token bucket rate limiter for the Gemini API calls, optionally shared by
+all the processes using the same state file, with exponential backoff and
+jitter after quota errors.
+"""
+
+import asyncio
+import json
+import os
+import random
+import threading
+import time
+
+
+class RateLimiter:
+
+    def __init__(  # noqa: PLR0913
+        self,
+        requests_per_minute=None,
+        tokens_per_minute=None,
+        path=None,
+        base_backoff_secs=1.0,
+        max_backoff_secs=60.0,
+        seed=None,
+    ):
+        """
+        requests_per_minute, tokens_per_minute: quotas to stay under, None for no limit.
+              both buckets start empty and refill continuously, so a new (or reset)
+              limiter does not let a whole minute of quota through at once.
+        path: file holding the buckets state, locked with fcntl, so that all the
+              processes (e.g. joblib workers) using the same path share the quota.
+              the state is only kept in this process if None.
+        base_backoff_secs, max_backoff_secs: after n consecutive errors, every
+              caller waits a random time up to min(max, base * 2**n) before its
+              next request (full jitter, so retries do not come back in sync).
+        """
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.path = path
+        self.base_backoff_secs = base_backoff_secs
+        self.max_backoff_secs = max_backoff_secs
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._state = None
+
+        if path is not None:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    def _initial_state(self):
+        return {
+            'requests': 0,
+            'tokens': 0,
+            'updated': time.time(),
+            'errors': 0,
+            'error_time': 0.0,
+        }
+
+    def _update(self, fn):
+        """applies fn to the state under the thread lock and, if shared, the file lock"""
+        with self._lock:
+            if self.path is None:
+                if self._state is None:
+                    self._state = self._initial_state()
+                return fn(self._state)
+
+            import fcntl
+
+            with open(self.path, 'a+') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    f.seek(0)
+                    content = f.read()
+                    state = json.loads(content) if content.strip() else self._initial_state()
+                    result = fn(state)
+                    f.seek(0)
+                    f.truncate()
+                    f.write(json.dumps(state))
+                    f.flush()
+                    return result
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _refill(self, state, now):
+        elapsed = max(0.0, now - state['updated'])
+        if self.requests_per_minute:
+            state['requests'] = min(self.requests_per_minute, state['requests'] + elapsed * self.requests_per_minute / 60)
+        if self.tokens_per_minute:
+            state['tokens'] = min(self.tokens_per_minute, state['tokens'] + elapsed * self.tokens_per_minute / 60)
+        state['updated'] = now
+
+    def _try_acquire(self, tokens, served=None):
+        """
+        takes one request and 'tokens' from the buckets, or returns how long to wait.
+        served: time of the last error whose backoff the caller already waited.
+
+        returns: (secs to wait, 0 if acquired, time of the last error served)
+        """
+        if self.tokens_per_minute and tokens > self.tokens_per_minute:
+            raise ValueError(f"asking for {tokens} tokens, more than the {self.tokens_per_minute} tokens per minute")
+
+        def acquire(state):
+            now = time.time()
+            self._refill(state, now)
+            error_time = state.get('error_time', 0.0)
+            if state['errors'] > 0 and error_time != served:
+                # full jitter: each caller waits its own random part of the backoff
+                wait = error_time + self.backoff(state['errors']) - now
+                if wait > 0:
+                    return wait, error_time
+
+            waits = [0.0]
+            if self.requests_per_minute and state['requests'] < 1:
+                waits.append((1 - state['requests']) * 60 / self.requests_per_minute)
+            if self.tokens_per_minute and state['tokens'] < tokens:
+                waits.append((tokens - state['tokens']) * 60 / self.tokens_per_minute)
+            if max(waits) > 0:
+                return max(waits) * (1 + self._random.uniform(0, 0.1)), error_time
+
+            if self.requests_per_minute:
+                state['requests'] -= 1
+            if self.tokens_per_minute:
+                state['tokens'] -= tokens
+            return 0.0, error_time
+
+        return self._update(acquire)
+
+    def acquire(self, tokens=0):
+        """blocks until one request with 'tokens' tokens fits in the quotas"""
+        served = None
+        while True:
+            wait, served = self._try_acquire(tokens, served)
+            if wait == 0:
+                return
+            time.sleep(wait)
+
+    async def acquire_async(self, tokens=0):
+        """same as acquire, without blocking the event loop"""
+        served = None
+        while True:
+            wait, served = self._try_acquire(tokens, served)
+            if wait == 0:
+                return
+            await asyncio.sleep(wait)
+
+    def report_error(self):
+        """
+        records a quota error: the next acquire of every caller waits its own
+        random delay, up to a bound growing exponentially with the consecutive
+        errors.
+        """
+        def error(state):
+            state['errors'] += 1
+            state['error_time'] = time.time()
+            # the buckets were probably over estimated, empty them
+            state['requests'] = min(state['requests'], 0)
+            state['tokens'] = min(state['tokens'], 0)
+
+        self._update(error)
+
+    def report_success(self):
+        """records a successful call, resetting the backoff"""
+        def success(state):
+            state['errors'] = 0
+
+        self._update(success)
+
+    def backoff(self, attempt):
+        """random delay in [0, min(max_backoff_secs, base_backoff_secs * 2**attempt)]"""
+        return self._random.uniform(0, min(self.max_backoff_secs, self.base_backoff_secs * 2**attempt))
+
+    def reset(self):
+        self._update(lambda state: state.update(self._initial_state()))
+
+
+def estimate_tokens(text):
+    """rough number of tokens of a text, about 4 characters per token"""
+    return len(text) // 4 + 1
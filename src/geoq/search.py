@@ -0,0 +1,157 @@
+"""Exact top-k search over embedding matrices (e.g. the columns of a
+`ChipStore`), scoring the database in blocks with a matrix product and
+keeping the k best of each query with argpartition.
+"""
+
+import numpy as np
+
+
+class SearchEngine:
+
+    def __init__(self, vectors, block_size=16384):
+        """
+        exact nearest neighbours search by squared euclidean distance.
+
+        vectors: [n, dim] database, e.g. `ChipStore.text_embedding`. it can be a
+              memmap, it is only read block by block. rows with NaNs (chips
+              without embedding) are never returned.
+        block_size: number of database rows scored at once, which bounds the
+              memory used by a search to about [n_queries, block_size] floats.
+        """
+        self.vectors = vectors
+        self.block_size = block_size
+        self.norms = self._compute_norms()
+
+    def _compute_norms(self):
+        norms = np.empty(len(self.vectors), dtype=np.float32)
+        for start in range(0, len(self.vectors), self.block_size):
+            block = np.asarray(self.vectors[start:start + self.block_size], dtype=np.float32)
+            norms[start:start + len(block)] = np.einsum('ij,ij->i', block, block)
+        # missing embeddings are infinitely far away
+        norms[np.isnan(norms)] = np.inf
+        return norms
+
+    def __len__(self):
+        return len(self.vectors)
+
+    def search(self, queries, k=10, rows=None):
+        """
+        queries: [n_queries, dim] (or [dim] for a single query)
+        k: number of neighbours for each query
+        rows: optional indices of the database rows to search in (e.g. the
+              chips inside an area), all of them if None
+
+        returns: distances [n_queries, k] (squared euclidean, ascending) and
+                 indices [n_queries, k] of the rows in the database
+        """
+        queries = np.asarray(queries, dtype=np.float32)
+        single = queries.ndim == 1
+        queries = np.atleast_2d(queries)
+
+        distances, indices = topk_blocks(
+            queries,
+            self._blocks(rows),
+            k,
+        )
+
+        if single:
+            return distances[0], indices[0]
+        return distances, indices
+
+    def _blocks(self, rows=None):
+        if rows is None:
+            for start in range(0, len(self.vectors), self.block_size):
+                block = np.asarray(self.vectors[start:start + self.block_size], dtype=np.float32)
+                yield np.arange(start, start + len(block)), block, self.norms[start:start + len(block)]
+            return
+
+        # sorted, so that reading a memmap goes forward
+        rows = np.unique(np.asarray(rows, dtype=np.int64))
+        for start in range(0, len(rows), self.block_size):
+            idxs = rows[start:start + self.block_size]
+            yield idxs, np.asarray(self.vectors[idxs], dtype=np.float32), self.norms[idxs]
+
+
+def squared_distances(queries, block, block_norms, queries_norms=None):
+    """
+    [n_queries, n_block] squared euclidean distances as |q|^2 + |b|^2 - 2 q.b,
+    so that the only large operation is a matrix product.
+    """
+    if queries_norms is None:
+        queries_norms = np.einsum('ij,ij->i', queries, queries)
+    d = queries @ block.T
+    d *= -2
+    d += queries_norms[:, None]
+    d += block_norms[None, :]
+    np.maximum(d, 0, out=d)
+    # rows with NaNs (missing embeddings) have infinite norms
+    d[:, ~np.isfinite(block_norms)] = np.inf
+    return d
+
+
+def candidate_distances(queries, candidates, vectors, dims=None, max_elements=2**24):
+    """
+    [n_queries, n_candidates] squared distances from each query to its
+    candidate rows of 'vectors' ([n_queries, n_candidates] indices, -1 for
+    none), in the order of the candidates. missing candidates and rows with
+    NaNs are at distance inf.
+
+    dims: only use the first 'dims' dimensions, all if None.
+    max_elements: bound on the size of the candidates vectors gathered at once.
+    """
+    queries = queries[:, :dims]
+    chunk = max(1, max_elements // max(1, candidates.shape[1] * queries.shape[1]))
+
+    distances = np.empty(candidates.shape, dtype=np.float32)
+    for start in range(0, len(queries), chunk):
+        q = queries[start:start + chunk]
+        rows = candidates[start:start + chunk]
+        block = np.asarray(vectors[np.maximum(rows, 0).ravel(), :dims], dtype=np.float32)
+        block = block.reshape(*rows.shape, -1)
+        d = np.einsum('qnd,qnd->qn', block, block) - 2 * np.einsum('qnd,qd->qn', block, q)
+        d += np.einsum('qd,qd->q', q, q)[:, None]
+        np.maximum(d, 0, out=d)
+        d[(rows < 0) | np.isnan(d)] = np.inf
+        distances[start:start + chunk] = d
+    return distances
+
+
+def topk_blocks(queries, blocks, k):
+    """
+    k smallest distances from the queries to the rows yielded by 'blocks', an
+    iterable of (indices, vectors, norms). only the k best of each query are
+    kept between blocks, selected with argpartition.
+
+    returns: distances and indices, [n_queries, k] sorted by distance. if
+             there are less than k rows, missing positions have distance inf
+             and index -1.
+    """
+    queries_norms = np.einsum('ij,ij->i', queries, queries)
+    best_d = np.zeros((len(queries), 0), dtype=np.float32)
+    best_i = np.zeros((len(queries), 0), dtype=np.int64)
+    for idxs, block, block_norms in blocks:
+        d = squared_distances(queries, block, block_norms, queries_norms)
+        d, i = topk(d, k)
+        best_d = np.concatenate([best_d, d], axis=1)
+        best_i = np.concatenate([best_i, idxs[i]], axis=1)
+        best_d, i = topk(best_d, k)
+        best_i = np.take_along_axis(best_i, i, axis=1)
+
+    order = np.argsort(best_d, axis=1, kind='stable')
+    best_d = np.take_along_axis(best_d, order, axis=1)
+    best_i = np.take_along_axis(best_i, order, axis=1)
+
+    if best_d.shape[1] < k:
+        missing = k - best_d.shape[1]
+        best_d = np.pad(best_d, ((0, 0), (0, missing)), constant_values=np.inf)
+        best_i = np.pad(best_i, ((0, 0), (0, missing)), constant_values=-1)
+    best_i[~np.isfinite(best_d)] = -1
+    return best_d, best_i
+
+
+def topk(d, k):
+    """k smallest values of each row of d (unsorted) and their column indices"""
+    if d.shape[1] <= k:
+        return d, np.broadcast_to(np.arange(d.shape[1]), d.shape)
+    i = np.argpartition(d, k - 1, axis=1)[:, :k]
+    return np.take_along_axis(d, i, axis=1), i
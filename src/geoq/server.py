@@ -0,0 +1,308 @@
+"""Local HTTP query service over a chip store.
+
+The store and the search index are loaded once at startup, and concurrent
+requests are micro-batched: their texts are embedded together and searched
+with a single matrix product.
+
+    python -m geoq.server --store /data/geoquery-48k-store --api-key gemini.key
+
+    GET  /search?q=football+stadiums&k=10
+    POST /search  {"q": "football stadiums", "k": 10}
+    GET  /health
+
+each search returns {"query", "chip_ids", "distances", "lonlats"}.
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import time
+from urllib.parse import parse_qs, urlsplit
+
+import numpy as np
+from loguru import logger
+
+from .search import SearchEngine
+from .store import ChipStore
+
+
+class EmbeddingError(RuntimeError):
+    """the embedder could not embed the texts of a batch"""
+
+
+class GeminiEmbedder:
+
+    def __init__(self, api_key, task_type="RETRIEVAL_DOCUMENT", **kwargs):
+        """
+        embeds query texts with `GeminiMultimodalModel.get_embeddings`, one
+        request per batch. kwargs are passed to `GeminiMultimodalModel`.
+        """
+        from .gemini import GeminiMultimodalModel
+
+        self.model = GeminiMultimodalModel(api_key, **kwargs)
+        self.task_type = task_type
+
+    def embed(self, texts):
+        """[len(texts), dim] float32 embeddings, NaN rows for failed texts"""
+        return self.model.get_embeddings(texts, task_type=self.task_type)
+
+
+class HashEmbedder:
+
+    def __init__(self, dim):
+        """
+        offline stand-in for a text embedder: a deterministic random vector
+        per text, to run the service without an API key (searches are
+        meaningless, but the whole path runs).
+        """
+        self.dim = dim
+
+    def embed(self, texts):
+        embeddings = np.empty((len(texts), self.dim), dtype=np.float32)
+        for i, text in enumerate(texts):
+            seed = int.from_bytes(hashlib.sha256(text.encode()).digest()[:8], 'little')
+            embeddings[i] = np.random.default_rng(seed).normal(size=self.dim)
+        return embeddings
+
+
+embedders = {"gemini": GeminiEmbedder, "stub": HashEmbedder}
+
+
+class QueryService:
+
+    def __init__(self, store, embedder, column='text_embedding', index=None, max_batch_size=64, max_wait_ms=5):
+        """
+        store: a `ChipStore`
+        embedder: object with an embed(texts) method returning [len(texts), dim]
+              embeddings in the space of 'column'
+        index: object with a search(queries, k) method returning distances and
+              rows, e.g. an `IVFIndex` built on the column. exact search with
+              `SearchEngine` if None.
+        max_batch_size: maximum number of requests searched together
+        max_wait_ms: how long the first request of a batch waits for others
+        """
+        self.store = store
+        self.embedder = embedder
+        self.column = column
+        self.index = index if index is not None else SearchEngine(store.embeddings(column))
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.lonlats = store.lonlats()
+        self.n_batches = 0
+        self.n_queries = 0
+        self._queue = None
+        self._batcher = None
+
+    async def start(self):
+        self._queue = asyncio.Queue()
+        self._batcher = asyncio.create_task(self._run_batches())
+
+    async def stop(self):
+        if self._batcher is not None:
+            self._batcher.cancel()
+            try:
+                await self._batcher
+            except asyncio.CancelledError:
+                pass
+
+    async def query(self, text, k=10):
+        """top k chips for 'text', as a json serializable dict"""
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((text, k, future))
+        return await future
+
+    async def _next_batch(self):
+        batch = [await self._queue.get()]
+        deadline = time.monotonic() + self.max_wait_ms / 1000
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run_batches(self):
+        while True:
+            batch = await self._next_batch()
+            texts = [text for text, _, _ in batch]
+            k = max(k for _, k, _ in batch)
+            try:
+                # embedding and search block, keep the event loop serving requests
+                results = await asyncio.to_thread(self._search, texts, k)
+            except Exception as e:
+                logger.exception("search failed")
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            self.n_batches += 1
+            self.n_queries += len(batch)
+            for (text, k, future), (distances, rows) in zip(batch, results):
+                if not future.done():
+                    future.set_result(self._describe(text, distances[:k], rows[:k]))
+
+    def _search(self, texts, k):
+        queries = self.embedder.embed(texts)
+        if queries.shape[1] == 0:
+            # get_embeddings returns no columns when every text failed
+            raise EmbeddingError(f"could not embed any of the {len(texts)} queries of the batch")
+        failed = np.isnan(queries).any(axis=1)
+        distances, rows = self.index.search(np.nan_to_num(queries), k=k)
+        distances[failed], rows[failed] = np.inf, -1
+        return list(zip(distances, rows))
+
+    def _describe(self, text, distances, rows):
+        rows = rows[rows >= 0]
+        return {
+            "query": text,
+            "chip_ids": [str(c) for c in self.store.chip_ids[rows]],
+            "distances": [float(d) for d in distances[:len(rows)]],
+            "lonlats": self.lonlats[rows].tolist(),
+        }
+
+
+class HTTPServer:
+
+    def __init__(self, service, host='127.0.0.1', port=8080, max_k=100):
+        """minimal HTTP/1.1 front end of a `QueryService`, one request per connection"""
+        self.service = service
+        self.host = host
+        self.port = port
+        self.max_k = max_k
+
+    async def serve(self):
+        await self.service.start()
+        server = await asyncio.start_server(self._handle, self.host, self.port)
+        logger.info(f"serving {len(self.service.store)} chips on http://{self.host}:{self.port}")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            await self.service.stop()
+
+    async def _handle(self, reader, writer):
+        try:
+            status, response = await self._respond(reader)
+        except EmbeddingError as e:
+            status, response = 502, {"error": str(e)}
+        except Exception as e:
+            logger.exception("request failed")
+            status, response = 500, {"error": str(e)}
+
+        body = json.dumps(response).encode()
+        writer.write(
+            f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\n"
+            f"Content-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: close\r\n\r\n".encode() + body
+        )
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def _respond(self, reader):
+        request_line = (await reader.readline()).decode('latin-1').split()
+        if len(request_line) != 3:
+            return 400, {"error": "malformed request"}
+        method, target, _ = request_line
+
+        headers = {}
+        while (line := (await reader.readline()).decode('latin-1').strip()) != '':
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        url = urlsplit(target)
+        if url.path == '/health':
+            health = {
+                "chips": len(self.service.store),
+                "column": self.service.column,
+                "batches": self.service.n_batches,
+                "queries": self.service.n_queries,
+            }
+            cache = getattr(getattr(self.service.embedder, 'model', None), 'embeddings_cache', None)
+            if cache is not None:
+                health["embeddings_cache"] = cache.stats()
+            return 200, health
+        if url.path != '/search':
+            return 404, {"error": f"unknown path '{url.path}'"}
+
+        if method == 'GET':
+            params = {k: v[0] for k, v in parse_qs(url.query).items()}
+        elif method == 'POST':
+            try:
+                length = int(headers.get('content-length', 0))
+            except ValueError:
+                return 400, {"error": "content-length must be an integer"}
+            try:
+                params = json.loads(await reader.readexactly(length)) if length > 0 else {}
+            except ValueError:
+                return 400, {"error": "the body must be valid json"}
+        else:
+            return 405, {"error": f"method {method} not allowed"}
+        if not isinstance(params, dict):
+            return 400, {"error": "the body must be a json object"}
+
+        text = params.get('q')
+        if not text:
+            return 400, {"error": "missing query 'q'"}
+        if not isinstance(text, str):
+            # it would fail the embedding of all the queries batched with it
+            return 400, {"error": "the query 'q' must be a string"}
+        try:
+            k = int(params.get('k', 10))
+        except (TypeError, ValueError):
+            return 400, {"error": f"k must be an integer, but found '{params['k']}'"}
+        if not 1 <= k <= self.max_k:
+            return 400, {"error": f"k must be between 1 and {self.max_k}"}
+
+        return 200, await self.service.query(text, k)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="serves text queries over a chip store")
+    parser.add_argument('--store', required=True, help="path of the chip store")
+    parser.add_argument('--column', default='text_embedding', help="embeddings column to search")
+    parser.add_argument('--index', default=None, help="optional IVFIndex .npz built on the column, exact search if not given")
+    parser.add_argument('--embedder', default='gemini', choices=sorted(embedders))
+    parser.add_argument('--api-key', default=None, help="Gemini api key, or the file to read it from")
+    parser.add_argument('--embeddings-cache', default=None, help="SQLite file caching the query embeddings")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--max-k', type=int, default=100)
+    parser.add_argument('--max-batch-size', type=int, default=64)
+    parser.add_argument('--max-wait-ms', type=float, default=5)
+    args = parser.parse_args(args)
+
+    store = ChipStore(args.store)
+    if args.embedder == 'gemini':
+        if args.api_key is None:
+            parser.error("--api-key is required with the gemini embedder")
+        embedder = GeminiEmbedder(args.api_key, embeddings_cache=args.embeddings_cache)
+    else:
+        embedder = HashEmbedder(store.embeddings(args.column).shape[1])
+
+    index = None
+    if args.index is not None:
+        from .ann import IVFIndex
+
+        index = IVFIndex.load(args.index)
+
+    service = QueryService(
+        store,
+        embedder,
+        column=args.column,
+        index=index,
+        max_batch_size=args.max_batch_size,
+        max_wait_ms=args.max_wait_ms,
+    )
+    asyncio.run(HTTPServer(service, host=args.host, port=args.port, max_k=args.max_k).serve())
+
+
+if __name__ == '__main__':
+    main()
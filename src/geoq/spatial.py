@@ -0,0 +1,154 @@
+"""Geographic filtering of chips before the vector search, so that queries
+restricted to an area (a bounding box, a polygon such as a country from
+`geom.get_world()`, or a radius around a point) only score the chips inside.
+"""
+
+import numpy as np
+
+from .search import SearchEngine
+
+earth_radius_km = 6371.0088
+
+
+class GridIndex:
+
+    def __init__(self, lonlats, cell_size=1.0):
+        """
+        spatial index bucketing the chips on a regular lon/lat grid, so that
+        finding the chips in an area only looks at the buckets it overlaps.
+
+        lonlats: [n, 2] lon, lat of the chips in degrees (e.g. `ChipStore.lonlats()`),
+              chips with NaN coordinates are never returned.
+        cell_size: size of the grid cells in degrees.
+        """
+        self.lonlats = np.asarray(lonlats, dtype=np.float64)
+        self.cell_size = cell_size
+        self.n_cols = int(np.ceil(360 / cell_size))
+        self.n_rows = int(np.ceil(180 / cell_size))
+
+        valid = np.flatnonzero(~np.isnan(self.lonlats).any(axis=1))
+        cells = self._cells(self.lonlats[valid])
+        order = np.argsort(cells, kind='stable')
+        self.rows = valid[order]
+        self.offsets = np.searchsorted(cells[order], np.arange(self.n_rows * self.n_cols + 1))
+
+    def __len__(self):
+        return len(self.lonlats)
+
+    def _col(self, lon):
+        return np.clip(((np.asarray(lon) + 180) // self.cell_size).astype(int), 0, self.n_cols - 1)
+
+    def _row(self, lat):
+        return np.clip(((np.asarray(lat) + 90) // self.cell_size).astype(int), 0, self.n_rows - 1)
+
+    def _cells(self, lonlats):
+        return self._row(lonlats[:, 1]) * self.n_cols + self._col(lonlats[:, 0])
+
+    def _candidates(self, min_lon, min_lat, max_lon, max_lat):
+        """rows in the cells overlapping a bbox (min_lon <= max_lon)"""
+        cols = np.arange(self._col(min_lon), self._col(max_lon) + 1)
+        rows = np.arange(self._row(min_lat), self._row(max_lat) + 1)
+        cells = (rows[:, None] * self.n_cols + cols[None, :]).ravel()
+        return np.concatenate(
+            [self.rows[self.offsets[c]:self.offsets[c + 1]] for c in cells]
+            or [np.zeros(0, dtype=np.int64)]
+        )
+
+    def rows_in_bbox(self, min_lon, min_lat, max_lon, max_lat):
+        """
+        sorted rows of the chips inside a lon/lat bounding box. if min_lon >
+        max_lon, the box crosses the antimeridian (e.g. 170, -20, -170, 20).
+        """
+        if min_lon > max_lon:
+            return np.union1d(
+                self.rows_in_bbox(min_lon, min_lat, 180, max_lat),
+                self.rows_in_bbox(-180, min_lat, max_lon, max_lat),
+            )
+
+        rows = self._candidates(min_lon, min_lat, max_lon, max_lat)
+        lon, lat = self.lonlats[rows].T
+        inside = (lon >= min_lon) & (lon <= max_lon) & (lat >= min_lat) & (lat <= max_lat)
+        return np.sort(rows[inside])
+
+    def rows_in_polygon(self, polygon):
+        """sorted rows of the chips inside a shapely (multi)polygon in lon/lat"""
+        import shapely
+
+        rows = self.rows_in_bbox(*polygon.bounds)
+        lon, lat = self.lonlats[rows].T
+        return rows[shapely.contains_xy(polygon, lon, lat)]
+
+    def rows_within(self, lon, lat, radius_km):
+        """sorted rows of the chips at most 'radius_km' (great circle) from lon, lat"""
+        angle = radius_km / earth_radius_km
+        dlat = np.degrees(angle)
+        min_lat, max_lat = lat - dlat, lat + dlat
+        if min_lat <= -90 or max_lat >= 90 or angle >= np.pi / 2:
+            # the circle contains a pole (or half the earth), all longitudes
+            rows = self.rows_in_bbox(-180, max(min_lat, -90), 180, min(max_lat, 90))
+        else:
+            # largest longitude difference on the circle
+            dlon = np.degrees(np.arcsin(min(1.0, np.sin(angle) / np.cos(np.radians(lat)))))
+            rows = self.rows_in_bbox(
+                (lon - dlon + 180) % 360 - 180, min_lat,
+                (lon + dlon + 180) % 360 - 180, max_lat,
+            )
+
+        distances = haversine_km(lon, lat, *self.lonlats[rows].T)
+        return rows[distances <= radius_km]
+
+    def rows_in(self, bbox=None, polygon=None, radius=None):
+        """
+        sorted rows of the chips inside an area, given as one of
+        bbox: (min_lon, min_lat, max_lon, max_lat), see `rows_in_bbox`
+        polygon: shapely (multi)polygon in lon/lat
+        radius: (lon, lat, radius_km)
+        """
+        areas = [a for a in (bbox, polygon, radius) if a is not None]
+        if len(areas) != 1:
+            raise ValueError(f"expecting exactly one of bbox, polygon or radius, but found {len(areas)}")
+
+        if bbox is not None:
+            return self.rows_in_bbox(*bbox)
+        if polygon is not None:
+            return self.rows_in_polygon(polygon)
+        return self.rows_within(*radius)
+
+
+def haversine_km(lon1, lat1, lon2, lat2):
+    """great circle distance in km between points in degrees"""
+    lon1, lat1, lon2, lat2 = (np.radians(v) for v in (lon1, lat1, lon2, lat2))
+    a = np.sin((lat2 - lat1) / 2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2)**2
+    return 2 * earth_radius_km * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+class GeoSearch:
+
+    def __init__(self, store, column='text_embedding', cell_size=1.0, block_size=16384):
+        """
+        vector search restricted to the chips of an area of a `ChipStore`:
+        the area is resolved to rows with a `GridIndex`, and only those rows
+        are scored.
+
+        column: 'text_embedding' or 'image_embedding'
+        """
+        self.store = store
+        self.column = column
+        self.grid = GridIndex(store.lonlats(), cell_size=cell_size)
+        self.engine = SearchEngine(store.embeddings(column), block_size=block_size)
+
+    def search(self, queries, k=10, bbox=None, polygon=None, radius=None):
+        """
+        queries: [n_queries, dim] (or [dim] for a single query)
+        k: number of chips for each query
+        bbox, polygon, radius: the area to search in, see `GridIndex.rows_in`.
+              the whole store if none is given.
+
+        returns: distances [n_queries, k] (squared euclidean, ascending) and
+                 rows [n_queries, k] of the chips in the store, -1 where the
+                 area has less than k chips.
+        """
+        rows = None
+        if any(a is not None for a in (bbox, polygon, radius)):
+            rows = self.grid.rows_in(bbox=bbox, polygon=polygon, radius=radius)
+        return self.engine.search(queries, k=k, rows=rows)
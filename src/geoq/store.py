@@ -0,0 +1,458 @@
+"""Columnar storage for chips, replacing one pickle per chip.
+
+A store is a folder with
+
+    store.yaml              number of chips and embeddings dims
+    metadata.parquet        one row per chip: chip_id, lon, lat, geometry (wkb),
+                            description, models used, ... and where its image is
+    text_embedding.npy      float32 [n, dim], NaN rows for chips without one
+    image_embedding.npy     float32 [n, dim], NaN rows for chips without one
+    images.bin              raw pixels of all chips, one after the other
+    updates/<column>/       append only segments with updated values of a
+                            column, folded into the files above by `compact`
+    .lock                   taken by `compact` (exclusive) and by readers of
+                            the segments (shared)
+
+so that the embeddings can be memory mapped at once, without reading any image.
+"""
+
+import os
+import pickle
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from itertools import islice
+
+import numpy as np
+import pandas as pd
+import yaml
+from loguru import logger
+
+embedding_columns = ("text_embedding", "image_embedding")
+image_columns = ("img_offset", "img_height", "img_width", "img_channels", "img_dtype")
+
+metadata_file = "metadata.parquet"
+images_file = "images.bin"
+description_file = "store.yaml"
+updates_dir = "updates"
+lock_file = ".lock"
+
+
+def read_pickle(fname):
+    with open(fname, 'rb') as f:
+        z = pickle.load(f)
+    z.setdefault('chip_id', os.path.basename(fname).split('.')[0])
+    return z
+
+
+def convert_pickles(files, path, n_threads=16, chunk_size=256):
+    """
+    converts chip pickle files (as in the geoquery-48k dataset) into a store at 'path'.
+    files are read with 'n_threads' threads, 'chunk_size' files at a time.
+    """
+    files = list(files)
+
+    def records():
+        it = iter(files)
+        with ThreadPoolExecutor(n_threads) as pool:
+            while True:
+                chunk = list(islice(it, chunk_size))
+                if len(chunk) == 0:
+                    break
+                yield from pool.map(read_pickle, chunk)
+
+    return write_store(path, records(), n=len(files))
+
+
+def write_store(path, records, n):
+    """
+    writes a store at 'path' from 'n' chip records, dicts with the same keys as
+    the chip pickles ('chip_id', 'img', 'text_embedding', 'image_embedding',
+    'lonlat', 'geometry', 'description', ...). only scalar values are kept as
+    metadata, besides 'lonlat' (as 'lon' and 'lat') and 'geometry' (as wkb).
+    """
+    os.makedirs(path, exist_ok=True)
+
+    embeddings = {}
+    rows = []
+    skipped = set()
+    offset = 0
+    count = 0
+    with open(f'{path}/{images_file}', 'wb') as images:
+        for i, z in enumerate(records):
+            row = {'chip_id': str(z['chip_id'])}
+
+            img = np.ascontiguousarray(z['img'])
+            row.update(
+                img_offset=offset,
+                img_height=img.shape[0],
+                img_width=img.shape[1],
+                img_channels=img.shape[2] if img.ndim == 3 else 1,
+                img_dtype=img.dtype.str,
+            )
+            images.write(img.tobytes())
+            offset += img.nbytes
+
+            for column in embedding_columns:
+                e = as_embedding(z.get(column))
+                if e is None:
+                    continue
+                if column not in embeddings:
+                    embeddings[column] = np.lib.format.open_memmap(
+                        f'{path}/{column}.npy', mode='w+', dtype=np.float32, shape=(n, len(e))
+                    )
+                    embeddings[column][:] = np.nan
+                embeddings[column][i] = e
+
+            if 'lonlat' in z:
+                row['lon'], row['lat'] = (float(v) for v in z['lonlat'])
+            if 'geometry' in z:
+                row['geometry'] = getattr(z['geometry'], 'wkb', None)
+
+            for k, v in z.items():
+                if k in row or k in embedding_columns or k in ('img', 'lonlat', 'geometry'):
+                    continue
+                if isinstance(v, np.generic):
+                    v = v.item()
+                if v is None or isinstance(v, (str, int, float, bool)):
+                    row[k] = v
+                elif k not in skipped:
+                    skipped.add(k)
+                    logger.warning(f"field '{k}' is not a scalar, not kept in the store metadata")
+
+            rows.append(row)
+            count += 1
+            if count % 5000 == 0:
+                logger.info(f"{count}/{n} chips written")
+
+    if count != n:
+        raise ValueError(f"expected {n} records but got {count}")
+
+    for e in embeddings.values():
+        e.flush()
+
+    pd.DataFrame(rows).to_parquet(f'{path}/{metadata_file}', index=False)
+    with open(f'{path}/{description_file}', 'w') as f:
+        yaml.safe_dump({
+            'n_chips': n,
+            'embeddings': {k: int(v.shape[1]) for k, v in embeddings.items()},
+        }, f)
+
+    logger.info(f"stored {n} chips in {path}")
+    return path
+
+
+def as_embedding(e):
+    """float32 vector from a stored embedding, None if missing or failed (e.g. an error string)"""
+    if e is None or isinstance(e, str):
+        return None
+    e = np.asarray(e, dtype=np.float32)
+    return e if e.ndim == 1 and len(e) > 0 else None
+
+
+def read_metadata(path):
+    return pd.read_parquet(f'{path}/{metadata_file}')
+
+
+def read_embeddings(path, column, mmap=True):
+    """[n, dim] float32 embeddings, as a read only memmap unless mmap=False"""
+    return np.load(f'{path}/{column}.npy', mmap_mode='r' if mmap else None)
+
+
+def read_image(path, row):
+    """image of the chip described by 'row' (a row of the metadata)"""
+    dtype = np.dtype(row['img_dtype'])
+    shape = (int(row['img_height']), int(row['img_width']), int(row['img_channels']))
+    count = int(np.prod(shape))
+    with open(f'{path}/{images_file}', 'rb') as f:
+        f.seek(int(row['img_offset']))
+        img = np.frombuffer(f.read(count * dtype.itemsize), dtype=dtype)
+    return img.reshape(shape) if shape[2] > 1 else img.reshape(shape[:2])
+
+
+@contextmanager
+def store_lock(path, exclusive=False):
+    """
+    fcntl lock on the store, so that readers never list segments that a
+    concurrent `compact` removes before they are loaded, and compactions do
+    not run at once. stores without write access (which nobody can compact)
+    are not locked.
+    """
+    import fcntl
+
+    try:
+        f = open(f'{path}/{lock_file}', 'a')
+    except OSError:
+        yield
+        return
+
+    with f:
+        fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def read_segments(path, column):
+    """paths of the pending update segments of a column, oldest first"""
+    folder = f'{path}/{updates_dir}/{column}'
+    if not os.path.isdir(folder):
+        return []
+    return sorted(
+        f'{folder}/{f}' for f in os.listdir(folder)
+        if not f.startswith('.') and f.endswith(('.npz', '.parquet'))
+    )
+
+
+def updated_columns(path):
+    folder = f'{path}/{updates_dir}'
+    if not os.path.isdir(folder):
+        return []
+    return sorted(c for c in os.listdir(folder) if len(read_segments(path, c)) > 0)
+
+
+def write_segment(path, column, write, extension):
+    """
+    writes a new update segment for 'column' calling write(tmp_path), and then
+    publishes it atomically with the next sequence number, so that readers
+    never see partial segments and concurrent writers never overwrite each other.
+    """
+    folder = f'{path}/{updates_dir}/{column}'
+    os.makedirs(folder, exist_ok=True)
+
+    tmp = f'{folder}/.{uuid.uuid4().hex}.{extension}'
+    write(tmp)
+    try:
+        while True:
+            existing = [os.path.basename(f).split('.')[0] for f in read_segments(path, column)]
+            seq = 1 + max([int(e) for e in existing], default=0)
+            segment = f'{folder}/{seq:08d}.{extension}'
+            try:
+                os.link(tmp, segment)  # fails if another writer took this number
+                return segment
+            except FileExistsError:
+                continue
+    finally:
+        os.unlink(tmp)
+
+
+def apply_metadata_segments(metadata, path, columns=None):
+    """metadata with the pending updates of its columns (or of 'columns') applied"""
+    for column in columns or updated_columns(path):
+        for segment in read_segments(path, column):
+            if not segment.endswith('.parquet'):
+                continue
+            z = pd.read_parquet(segment)
+            set_metadata_values(metadata, column, z['row'].values, z['value'])
+    return metadata
+
+
+def set_metadata_values(metadata, column, rows, values):
+    """sets the values of a metadata column at the given rows, in place"""
+    values = pd.Series(values)
+    if column not in metadata.columns:
+        metadata[column] = pd.Series([None] * len(metadata), dtype=object)
+    if metadata[column].dtype != values.dtype:
+        metadata[column] = metadata[column].astype(object)
+    metadata.iloc[rows, metadata.columns.get_loc(column)] = values.values
+
+
+def apply_embeddings_segments(embeddings, segments):
+    """applies the update segments to an embeddings array, in place"""
+    for segment in segments:
+        z = np.load(segment)
+        embeddings[z['rows']] = z['values']
+    return embeddings
+
+
+def compact(path, columns=None):
+    """
+    folds the pending updates of 'columns' (all by default) into the store
+    files, replacing them atomically, and removes the applied segments.
+    processes with the store open keep reading the previous files.
+    """
+    with store_lock(path, exclusive=True):
+        _compact(path, columns)
+
+
+def _compact(path, columns):
+    columns = updated_columns(path) if columns is None else columns
+    metadata_columns = []
+    for column in columns:
+        segments = read_segments(path, column)
+        if len(segments) == 0:
+            continue
+
+        if segments[0].endswith('.parquet'):
+            metadata_columns.append(column)
+            continue
+
+        n = len(read_metadata(path))
+        target = f'{path}/{column}.npy'
+        base = read_embeddings(path, column) if os.path.isfile(target) else None
+        dim = base.shape[1] if base is not None else np.load(segments[0])['values'].shape[1]
+
+        tmp = f'{path}/.{column}.{uuid.uuid4().hex}.npy'
+        embeddings = np.lib.format.open_memmap(tmp, mode='w+', dtype=np.float32, shape=(n, dim))
+        if base is None:
+            embeddings[:] = np.nan
+        else:
+            for start in range(0, n, 65536):
+                embeddings[start:start + 65536] = base[start:start + 65536]
+        apply_embeddings_segments(embeddings, segments)
+        embeddings.flush()
+        del embeddings
+        os.replace(tmp, target)
+        _update_description(path, column, dim)
+
+        for segment in segments:
+            os.unlink(segment)
+        logger.info(f"compacted {len(segments)} updates of '{column}'")
+
+    if len(metadata_columns) > 0:
+        segments = {c: read_segments(path, c) for c in metadata_columns}
+        metadata = apply_metadata_segments(read_metadata(path), path, metadata_columns)
+        tmp = f'{path}/.{uuid.uuid4().hex}.parquet'
+        metadata.to_parquet(tmp, index=False)
+        os.replace(tmp, f'{path}/{metadata_file}')
+
+        for column, column_segments in segments.items():
+            for segment in column_segments:
+                os.unlink(segment)
+            logger.info(f"compacted {len(column_segments)} updates of '{column}'")
+
+
+def _update_description(path, column, dim):
+    with open(f'{path}/{description_file}') as f:
+        description = yaml.safe_load(f)
+    description.setdefault('embeddings', {})[column] = int(dim)
+    tmp = f'{path}/.{uuid.uuid4().hex}.yaml'
+    with open(tmp, 'w') as f:
+        yaml.safe_dump(description, f)
+    os.replace(tmp, f'{path}/{description_file}')
+
+
+class ChipStore:
+
+    def __init__(self, path):
+        """
+        read only access to a store. embeddings are exposed as read only memmaps,
+        so several processes searching the same store share them through the
+        page cache, and images are only read when asked for.
+        """
+        if not os.path.isfile(f'{path}/{metadata_file}'):
+            raise ValueError(f"'{path}' is not a chip store, '{metadata_file}' not found")
+
+        self.path = path
+        with store_lock(path):
+            self.metadata = apply_metadata_segments(read_metadata(path), path)
+        self.chip_ids = self.metadata['chip_id'].values
+        self._index = pd.Index(self.chip_ids)
+        self._embeddings = {}
+        self._images = None
+
+    def __len__(self):
+        return len(self.metadata)
+
+    def embeddings(self, column):
+        """
+        [n, dim] read only float32 memmap with the 'text_embedding' or
+        'image_embedding' of all chips. if the column has pending updates, they
+        are applied on an in memory copy instead, until the store is compacted.
+        """
+        if column not in self._embeddings:
+            with store_lock(self.path):
+                self._embeddings[column] = self._load_embeddings(column)
+        return self._embeddings[column]
+
+    def _load_embeddings(self, column):
+        segments = read_segments(self.path, column)
+        if len(segments) == 0:
+            return read_embeddings(self.path, column, mmap=True)
+
+        logger.warning(f"'{column}' has {len(segments)} pending updates, loading it in memory. compact the store to memory map it again")
+        if os.path.isfile(f'{self.path}/{column}.npy'):
+            e = read_embeddings(self.path, column, mmap=False)
+        else:
+            dim = np.load(segments[0])['values'].shape[1]
+            e = np.full((len(self), dim), np.nan, dtype=np.float32)
+        e = apply_embeddings_segments(e, segments)
+        e.setflags(write=False)
+        return e
+
+    @property
+    def text_embedding(self):
+        return self.embeddings('text_embedding')
+
+    @property
+    def image_embedding(self):
+        return self.embeddings('image_embedding')
+
+    def row(self, chip_id):
+        """row index of a chip_id"""
+        return self._index.get_loc(chip_id)
+
+    def rows(self, chip_ids):
+        """row indices of a list of chip_ids"""
+        rows = self._index.get_indexer(chip_ids)
+        if (rows < 0).any():
+            missing = np.asarray(chip_ids)[rows < 0]
+            raise KeyError(f"chip ids not in the store: {list(missing[:10])}")
+        return rows
+
+    def lonlats(self, rows=None):
+        """[n, 2] lon, lat of all chips, or of the given rows"""
+        m = self.metadata if rows is None else self.metadata.iloc[rows]
+        return m[['lon', 'lat']].values
+
+    def image(self, key):
+        """
+        image of a chip, by chip_id or by row index. it is a read only view
+        on the images file, only the pages of this image are read.
+        """
+        row = key if isinstance(key, (int, np.integer)) else self.row(key)
+        if self._images is None:
+            self._images = np.memmap(f'{self.path}/{images_file}', dtype=np.uint8, mode='r')
+
+        m = self.metadata.iloc[row]
+        dtype = np.dtype(m['img_dtype'])
+        shape = (int(m['img_height']), int(m['img_width']), int(m['img_channels']))
+        start = int(m['img_offset'])
+        img = self._images[start:start + int(np.prod(shape)) * dtype.itemsize].view(dtype)
+        return img.reshape(shape) if shape[2] > 1 else img.reshape(shape[:2])
+
+    def images(self, keys):
+        """generator with the images of the given chip_ids or rows"""
+        for key in keys:
+            yield self.image(key)
+
+    def update(self, column, chip_ids, values):
+        """
+        updates 'column' for the given chip_ids, writing only the new values in
+        an append only segment (see `compact` to fold them into the store).
+
+        values: [len(chip_ids), dim] for embeddings columns (any 2d array), or a
+                list of scalars for metadata columns (e.g. 'description').
+        """
+        if column in ('chip_id',) + image_columns:
+            raise ValueError(f"column '{column}' cannot be updated")
+
+        rows = self.rows(chip_ids)
+        if np.ndim(values) == 2:
+            values = np.asarray(values, dtype=np.float32)
+            if len(values) != len(rows):
+                raise ValueError(f"got {len(rows)} chip ids but {len(values)} embeddings")
+            write_segment(self.path, column, lambda f: np.savez(f, rows=rows, values=values), 'npz')
+            self._embeddings.pop(column, None)
+        else:
+            update = pd.DataFrame({'row': rows, 'chip_id': self.chip_ids[rows], 'value': list(values)})
+            write_segment(self.path, column, lambda f: update.to_parquet(f, index=False), 'parquet')
+            set_metadata_values(self.metadata, column, rows, update['value'])
+
+    def compact(self, columns=None):
+        """folds pending updates into the store files (see `compact`) and reloads them"""
+        compact(self.path, columns)
+        with store_lock(self.path):
+            self.metadata = apply_metadata_segments(read_metadata(self.path), self.path)
+        self._embeddings = {}